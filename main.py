@@ -6,7 +6,8 @@ import sys
 import traceback
 
 import mossy.plugins
-from mossy import sql, estimate, parse_config
+from mossy.plugins import concept_comparers, ferreira, gic_ui
+from mossy import sql, estimate, iri_dictionary, parse_config, snapshot, utils
 
 
 def get_database_params(args):
@@ -81,6 +82,18 @@ def get_database_params(args):
     return hostname, database, username, password
 
 
+def print_similar_pairs(config, output):
+    # Instead of comparing every pair of items, let the comparer find the
+    # pairs that are similar enough
+    names = config.join["names"]
+    items = [config.items[name] for name in names]
+    pairs = config.comparer.join(items, config.join["threshold"],
+                                 **config.join["options"])
+    for one, two, similarity in pairs:
+        print("{}\t{}\t{:5f}".format(names[one], names[two], similarity),
+              file=output)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Perform semantic similarity "
                                      "based on an OWLtoSQL database.",
@@ -151,6 +164,97 @@ def main():
                         help="The username used to access the database.")
     parser.add_argument("-p", "--password",
                         help="The password associated with the username.")
+    parser.add_argument("--sqlite", metavar="FILE",
+                        help="Use the given SQLite file instead of a MySQL "
+                             "database. The file must contain the same tables "
+                             "as an OWLtoSQL database. When this is given, "
+                             "the MySQL parameters are ignored.")
+    parser.add_argument("--export-sqlite", metavar="FILE",
+                        help="Copy the tables of the MySQL database into the "
+                             "given SQLite file, to be used later with "
+                             "--sqlite, and exit.")
+    
+    # Performance arguments
+    parser.add_argument("--pool-size", type=int, default=1,
+                        help="The number of connections to open to the "
+                             "database. Plugins that run in multiple threads "
+                             "can keep one query in flight on each "
+                             "connection. Defaults to 1.")
+    parser.add_argument("--iri-dictionary", metavar="FILE",
+                        help="A file where the IRIs and ids of the entities "
+                             "in the database are stored between runs. The "
+                             "file is created if it does not exist, and "
+                             "rebuilt whenever the entities in the database "
+                             "change.")
+    parser.add_argument("--cache-ancestors", action="store_true",
+                        help="If provided, the superclasses of each concept "
+                             "are fetched from the database only once and "
+                             "kept in memory, and the most informative common "
+                             "ancestor of two concepts is computed without "
+                             "querying the database.")
+    parser.add_argument("--cache-closures", action="store_true",
+                        help="If provided, sim_ui and sim_gic read the "
+                             "superclasses of each item from the database "
+                             "only once and keep them in memory, and compare "
+                             "items without querying the database.")
+    parser.add_argument("--staging-size", type=int, metavar="N",
+                        help="If provided, when sim_ui or sim_gic compare an "
+                             "item with at least N concepts, the ids are "
+                             "loaded into temporary tables instead of being "
+                             "written into the text of the queries.")
+    parser.add_argument("--combined-queries", action="store_true",
+                        help="If provided, lin and jiang fetch the "
+                             "information content of both concepts and "
+                             "their shared information content, including "
+                             "the disjointness correction, in a single "
+                             "query for each pair. Ignored when the values "
+                             "are kept in memory, with --snapshot, "
+                             "--cache-ancestors or --preload-ic.")
+    parser.add_argument("--index-disjoints", action="store_true",
+                        help="If provided, the distances between disjoint "
+                             "classes are read once from the database, and "
+                             "the disjointness factor of each pair of "
+                             "concepts is computed from them.")
+    parser.add_argument("--pair-cache", type=float, metavar="MB",
+                        help="If provided, the shared information content of "
+                             "the most recently compared pairs of concepts is "
+                             "kept in memory, using about this many "
+                             "megabytes.")
+    parser.add_argument("--neighborhood-cache", type=int, metavar="N",
+                        help="If provided, the ferreira comparer keeps in "
+                             "memory the neighborhoods of the N most recently "
+                             "compared items.")
+    parser.add_argument("--preload-relations", action="store_true",
+                        help="If provided, the existential relations and the "
+                             "hierarchy are loaded into memory, and the "
+                             "ferreira comparer constructs neighborhoods "
+                             "without querying the database.")
+    parser.add_argument("--preload-ic", action="store_true",
+                        help="If provided, each information content measure "
+                             "is read from the database in a single query "
+                             "the first time it is used, instead of one "
+                             "concept at a time.")
+    parser.add_argument("--preload-parent-ic", action="store_true",
+                        help="If provided, the maximum information content of "
+                             "the direct superclasses of each concept, used "
+                             "with disjointness, is computed for all the "
+                             "concepts in a single query.")
+    parser.add_argument("--parent-ic-table", metavar="TABLE",
+                        help="If provided, implies --preload-parent-ic, and "
+                             "the values are stored in the given table of the "
+                             "database so that later runs can reuse them. "
+                             "They are computed again if the hierarchy or the "
+                             "information content changes.")
+    parser.add_argument("--compile-items", action="store_true",
+                        help="If provided, the IRIs in the items are replaced "
+                             "by their ids once, before the comparisons, "
+                             "instead of in every comparison.")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="If provided, the hierarchy, the information "
+                             "content tables and the IRIs of the ontology are "
+                             "loaded into memory at startup, and concept "
+                             "comparers no longer query the database for "
+                             "each comparison.")
     
     # Parse the arguments
     args = parser.parse_args()
@@ -184,22 +288,73 @@ def main():
             level=args.log_level,
             stream=args.log)
     
-    # Get the database parameters
-    try:
-        db_params = get_database_params(args)
-    except Exception as e:
-        parser.error(e)
+    if args.sqlite is not None:
+        # Use the SQLite file directly
+        try:
+            sql.set_sqlite_connection(args.sqlite, pool_size=args.pool_size)
+        except sql.DatabaseError as e:
+            parser.error(e)
     
-    # Start a connection to the database
-    try:
-        sql.set_connection(*db_params)
-    except sql.MySQLError as e:
-        parser.error(e.args[1])
+    else:
+        # Get the database parameters
+        try:
+            db_params = get_database_params(args)
+        except Exception as e:
+            parser.error(e)
+        
+        # Start a connection to the database
+        try:
+            sql.set_connection(*db_params, pool_size=args.pool_size)
+        except ImportError as e:
+            parser.error(e)
+        except sql.MySQLError as e:
+            parser.error(e.args[1])
+    
+    if args.export_sqlite is not None:
+        sql.export_to_sqlite(args.export_sqlite)
+        sys.exit(0)
+    
+    if args.iri_dictionary is not None:
+        logging.info("Opening the IRI dictionary %s", args.iri_dictionary)
+        iri_dictionary.open_dictionary(args.iri_dictionary)
+    
+    if args.snapshot:
+        logging.info("Loading the snapshot of the database")
+        snapshot.load_snapshot()
+    
+    concept_comparers.CACHE_ANCESTORS = args.cache_ancestors
+    gic_ui.CACHE_CLOSURES = args.cache_closures
+    gic_ui.STAGING_SIZE = args.staging_size
+    ferreira.PRELOAD_RELATIONS = args.preload_relations
+    concept_comparers.PRELOAD_IC = args.preload_ic
+    concept_comparers.INDEX_DISJOINTS = args.index_disjoints
+    concept_comparers.COMBINED_QUERIES = args.combined_queries
+    concept_comparers.PRELOAD_PARENT_IC = \
+        args.preload_parent_ic or args.parent_ic_table is not None
+    concept_comparers.PARENT_IC_TABLE = args.parent_ic_table
+    pair_cache = concept_comparers.set_pair_cache(args.pair_cache)
+    neighborhood_cache = ferreira.set_neighborhood_cache(
+        args.neighborhood_cache)
     
     # Read the configuration file and the extra execution lines provided with
     # the -e flag
     config = parse_config.parse_config(args.config, args.execute)
     
+    # Resolve the IRIs of all the items at once, rather than one at a time
+    # during the comparisons
+    logging.info("Resolving the IRIs of %d items", len(config.items))
+    utils.prefetch_ids(utils.iter_strings(list(config.items.values())))
+    
+    if args.compile_items:
+        config.items = {name: utils.compile_item(item)
+                        for name, item in config.items.items()}
+    
+    if config.join is not None:
+        if not hasattr(config.comparer, 'join'):
+            parser.error("The comparer cannot find the similar pairs of items")
+        print_similar_pairs(config, args.output)
+        return
+    
     if args.eta:
         eta = estimate.ETA(config.total, sys.stderr)
         eta.start()
@@ -215,7 +370,7 @@ def main():
         
         try:
             similarity = config.comparer.compare(*group)
-        except sql._driver.MySQLError as e:
+        except sql.DatabaseError as e:
             raise e
         except Exception as e:
             print("Unable to compare {}".format(", ".join(sb)), file=args.log)
@@ -232,6 +387,14 @@ def main():
     
     if args.eta:
         eta.finish()
+    
+    if pair_cache is not None:
+        logging.info("Pair cache: %d hits, %d misses",
+                     pair_cache.hits, pair_cache.misses)
+    
+    if neighborhood_cache is not None:
+        logging.info("Neighborhood cache: %d hits, %d misses",
+                     neighborhood_cache.hits, neighborhood_cache.misses)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,199 @@
+# This module implements a persistent dictionary between the IRIs of the
+# entities in the database and their ids. The dictionary is a file that is
+# memory-mapped when opened, so that it can be shared by many runs against the
+# same database without reading the `owl_objects` table again. The file
+# records a fingerprint of the `owl_objects` table and is rebuilt whenever the
+# table changes.
+#
+# The file is laid out as follows (all integers in the native byte order):
+#
+#   magic          8 bytes, b"MOSSYIRI"
+#   count          unsigned 64-bit integer, the number of entities
+#   max_id         signed 64-bit integer
+#   fp_length      unsigned 64-bit integer, the length of the fingerprint
+#   fingerprint    fp_length bytes, padded to a multiple of 8 bytes
+#   ids            count signed 64-bit integers, in ascending order
+#   offsets        count + 1 unsigned 64-bit integers; the key of the entity
+#                  ids[k] is blob[offsets[k]:offsets[k + 1]]
+#   by_key         count unsigned 64-bit integers, the positions (in `ids`)
+#                  of the entities sorted by their key
+#   blob           the keys, each being the UTF-8 encoding of "iri\ttype"
+
+import mmap
+import os
+import struct
+
+from array import array
+
+from mossy import sql
+
+
+MAGIC = b"MOSSYIRI"
+HEADER = struct.Struct("=8sQqQ")
+
+current = None
+
+def open_dictionary(filename):
+    global current
+    current = IRIDictionary(filename)
+    return current
+
+
+def close_dictionary():
+    global current
+    if current is not None:
+        current.close()
+    current = None
+
+
+def get_fingerprint():
+    # Any insertion, deletion or renaming of entities is very likely to
+    # change at least one of these values
+    with sql.borrow() as cursor:
+        cursor.execute(
+            "SELECT COUNT(*), MAX(id), SUM(id), "
+            "       SUM(LENGTH(iri)), SUM(LENGTH(type)) "
+            "FROM owl_objects")
+        row = cursor.fetchone()
+    return ":".join(str(int(value or 0)) for value in row)
+
+
+def pad(length):
+    return -length % 8
+
+
+def write_dictionary(filename, fingerprint):
+    with sql.borrow() as cursor:
+        cursor.execute("SELECT id, iri, type FROM owl_objects ORDER BY id")
+        rows = cursor.fetchall()
+    
+    keys = ["{}\t{}".format(iri, entity_type).encode("utf-8")
+            for entity_id, iri, entity_type in rows]
+    ids = [row[0] for row in rows]
+    by_key = sorted(range(len(keys)), key=keys.__getitem__)
+    
+    offsets = [0]
+    for key in keys:
+        offsets.append(offsets[-1] + len(key))
+    
+    fingerprint = fingerprint.encode("utf-8")
+    max_id = ids[-1] if ids else 0
+    
+    # Write to a temporary file first, so that other runs never see a
+    # partially written dictionary
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    with open(tmp_filename, "wb") as file:
+        file.write(HEADER.pack(MAGIC, len(ids), max_id, len(fingerprint)))
+        file.write(fingerprint + b"\0" * pad(len(fingerprint)))
+        file.write(array("q", ids).tobytes())
+        file.write(array("Q", offsets).tobytes())
+        file.write(array("Q", by_key).tobytes())
+        file.write(b"".join(keys))
+    os.replace(tmp_filename, filename)
+
+
+class IRIDictionary:
+    
+    def __init__(self, filename):
+        fingerprint = get_fingerprint()
+        
+        if not self.open(filename, fingerprint):
+            write_dictionary(filename, fingerprint)
+            if not self.open(filename, fingerprint):
+                raise Exception("Unable to read the IRI dictionary {!r}"
+                                .format(filename))
+    
+    
+    def open(self, filename, fingerprint):
+        # Returns False if the file does not exist or belongs to another
+        # version of the database
+        try:
+            file = open(filename, "rb")
+        except FileNotFoundError:
+            return False
+        
+        with file:
+            header = file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return False
+            magic, count, max_id, fp_length = HEADER.unpack(header)
+            if magic != MAGIC or file.read(fp_length) != \
+                    fingerprint.encode("utf-8"):
+                return False
+            
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        self.count = count
+        self.max_id = max_id
+        
+        start = HEADER.size + fp_length + pad(fp_length)
+        self.view = view = memoryview(self.map)
+        
+        end = start + 8 * count
+        self.ids = view[start:end].cast("q")
+        start, end = end, end + 8 * (count + 1)
+        self.offsets = view[start:end].cast("Q")
+        start, end = end, end + 8 * count
+        self.by_key = view[start:end].cast("Q")
+        self.blob_start = end
+        
+        return True
+    
+    
+    def close(self):
+        self.ids.release()
+        self.offsets.release()
+        self.by_key.release()
+        self.view.release()
+        self.map.close()
+    
+    
+    def get_key(self, position):
+        start = self.blob_start + self.offsets[position]
+        end = self.blob_start + self.offsets[position + 1]
+        return self.map[start:end]
+    
+    
+    def get_id(self, iri, entity_type):
+        """
+        Returns the id of the given entity, or `None` if it is not in the
+        database.
+        """
+        
+        key = "{}\t{}".format(iri, entity_type).encode("utf-8")
+        
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_key(self.by_key[middle]) < key:
+                low = middle + 1
+            else:
+                high = middle
+        
+        if low < self.count:
+            position = self.by_key[low]
+            if self.get_key(position) == key:
+                return self.ids[position]
+        
+        return None
+    
+    
+    def get_entity(self, entity_id):
+        """
+        Returns the (iri, type) tuple of the entity with the given id, or
+        `None` if there is no such entity in the database.
+        """
+        
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.ids[middle] < entity_id:
+                low = middle + 1
+            else:
+                high = middle
+        
+        if low < self.count and self.ids[low] == entity_id:
+            iri, entity_type = self.get_key(low).decode("utf-8").split("\t")
+            return iri, entity_type
+        
+        return None
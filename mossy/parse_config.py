@@ -33,14 +33,15 @@ class NamespaceUnroller(ast.NodeVisitor):
 
 class Config:
     
-    def __init__(self, comparer, items, groups, total):
+    def __init__(self, comparer, items, groups, total, join=None):
         self.comparer = comparer
         self.items = items
         self.groups = groups
         self.total = total
+        self.join = join
 
 
-RESERVED_NAMES = ("named_items", "items", "total")
+RESERVED_NAMES = ("named_items", "items", "total", "join")
 MACRO_FUNCTIONS = set()
 
 def config_macro(inner):
@@ -120,16 +121,18 @@ def execute_code(root, filename, inner_globals):
                 
                 for keyword_node in call_node.keywords:
                     assert_safe_expr(keyword_node.value)
-                    kwargs[keyword_node.id] = \
-                        evaluate(arg_node, filename, inner_globals)
+                    kwargs[keyword_node.arg] = \
+                        evaluate(keyword_node.value, filename, inner_globals)
                 
-                if call_node.starargs is not None:
+                # Since Python 3.5, the starred arguments are part of `args`
+                # and `keywords` instead
+                if getattr(call_node, "starargs", None) is not None:
                     assert_safe_expr(call_node.starargs)
                     stararg = \
                         evaluate(call_node.starargs, filename, inner_globals)
                     args.extend(*stararg)
                 
-                if call_node.kwargs is not None:
+                if getattr(call_node, "kwargs", None) is not None:
                     assert_safe_expr(call_node.kwargs)
                     kw = evaluate(call_node.kwargs, filename, inner_globals)
                     for key, value in kw.items():
@@ -265,6 +268,21 @@ def make_all_pairs(*, inner_globals):
     inner_globals["total"] = len(names) * (len(names) + 1) // 2
 
 
+@config_macro
+def make_similar_pairs(threshold, min_ic=None, *, inner_globals):
+    # Like `make_all_pairs`, but only the pairs whose similarity is at least
+    # `threshold` are output. Instead of comparing every pair, the comparer
+    # finds the similar pairs on its own, so it must provide a `join` method.
+    # If `min_ic` is given, it is passed to the comparer too
+    make_all_pairs(inner_globals=inner_globals)
+    names = sorted(i for i in inner_globals["named_items"] if i[0] != '_')
+    
+    join = {"names": names, "threshold": threshold, "options": {}}
+    if min_ic is not None:
+        join["options"]["min_ic"] = min_ic
+    inner_globals["join"] = join
+
+
 @config_macro
 def add_random_pairs(n, *, inner_globals):
     # Select all named items that are actual items for comparison
@@ -373,4 +391,4 @@ def parse_config(files, commands):
     else:
         total = len(groups)
     
-    return Config(comparer, items, groups, total)
+    return Config(comparer, items, groups, total, inner_globals.get("join"))
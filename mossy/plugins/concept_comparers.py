@@ -1,7 +1,85 @@
-from mossy import sql, utils
+import logging
+import threading
+
+from array import array
+from collections import defaultdict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mossy import snapshot, sql, utils
 from mossy.parse_config import plugin
 
 
+# When True, the superclasses of each concept are fetched only once, and the
+# most informative common ancestor of two concepts is computed in Python. This
+# trades memory for the queries that would otherwise be sent for each pair.
+CACHE_ANCESTORS = False
+
+# When True, the IC calculators read their whole column from the database the
+# first time they are used, instead of one value at a time
+PRELOAD_IC = False
+
+# When True, the maximum IC of the direct superclasses of every concept, which
+# the disjointness correction needs for each MICA, is computed for all the
+# concepts at once with a single query
+PRELOAD_PARENT_IC = False
+
+# When set, the maximum IC of the direct superclasses is stored in a table
+# with this name, next to the IC tables, so that it is computed only once for
+# each database. The values are computed again whenever the hierarchy or the
+# IC values change.
+PARENT_IC_TABLE = None
+
+# When True, `lin` and `jiang` fetch the IC of both concepts and their shared
+# IC, including the disjointness correction, with a single query for each
+# pair, instead of one query for each value. Values that are kept in memory
+# (by a snapshot, the ancestor cache or the preloaded IC values) are used
+# instead whenever they are available, and the pairs whose shared IC is in
+# the pair cache only read the IC of their concepts
+COMBINED_QUERIES = False
+
+def use_combined_queries():
+    return (COMBINED_QUERIES and snapshot.current is None and
+            not CACHE_ANCESTORS and not PRELOAD_IC)
+
+def use_matrix():
+    # The matrices of `resnik`, `lin` and `jiang` need every superclass of
+    # each concept, which is only cheap when they are kept in memory; without
+    # a snapshot or the ancestor cache, comparing the pairs with
+    # `.compare_many` can use the pair cache and the combined queries instead
+    return CACHE_ANCESTORS or snapshot.current is not None
+
+# When True, the disjointness factor is computed from an index of the
+# distances between disjoint classes, built with a single query, instead of
+# running a large query for each pair
+INDEX_DISJOINTS = False
+
+# When set, the shared IC of each pair of concepts is remembered in this
+# cache, shared by all the calculators (see `set_pair_cache`)
+PAIR_CACHE = None
+
+# A rough estimate of the memory used by each entry of the pair cache, in
+# bytes, including the key and the bookkeeping of the cache
+PAIR_CACHE_ENTRY_SIZE = 250
+
+def set_pair_cache(megabytes):
+    """
+    Remembers the shared IC of the most recently compared pairs of concepts,
+    using about the given amount of memory. With `None`, nothing is cached.
+    """
+    
+    global PAIR_CACHE
+    if megabytes is None:
+        PAIR_CACHE = None
+    else:
+        maxsize = int(megabytes * 2 ** 20 / PAIR_CACHE_ENTRY_SIZE)
+        PAIR_CACHE = utils.LRUCache(maxsize)
+    return PAIR_CACHE
+
+
 def table_column_from_ic(ic):
     sql.assert_identifier(ic)
     
@@ -19,38 +97,500 @@ class ArgSingleton(type):
     
     __instances = {}
     
+    # Makes sure that only one instance is created even when several threads
+    # ask for it at the same time. Instances may create other instances in
+    # their constructors, hence the reentrant lock.
+    __lock = threading.RLock()
+    
     def __call__(cls, *args):
         if (cls, args) in ArgSingleton.__instances:
             return ArgSingleton.__instances[cls, args]
         
-        result = super().__call__(*args)
-        ArgSingleton.__instances[cls, args] = result
-        return result
+        with ArgSingleton.__lock:
+            if (cls, args) in ArgSingleton.__instances:
+                return ArgSingleton.__instances[cls, args]
+            
+            result = super().__call__(*args)
+            ArgSingleton.__instances[cls, args] = result
+            return result
+
+
+def read_max_values(query, args=()):
+    # Reads the (concept, value) rows of the query into a dense array indexed
+    # by concept id, with 0 for the concepts without a value
+    concepts = array('l')
+    maximums = array('d')
+    with sql.borrow_streaming() as cursor:
+        cursor.execute(query, args)
+        for concept, value in cursor:
+            if value is not None:
+                concepts.append(concept)
+                maximums.append(value)
+    
+    values = array('d', [0]) * (max(concepts, default=-1) + 1)
+    for concept, value in zip(concepts, maximums):
+        values[concept] = value
+    return values
 
 
 class ICCalculator(metaclass=ArgSingleton):
     
     def __init__(self, ic):
         table, column = table_column_from_ic(ic)
+        self.table = table
+        self.column = column
         self.get_ic_query = ("SELECT {} FROM {} WHERE id = %s"
                              .format(column, table))
         self._cache = {}
+        self.values = None
+        self.parent_values = None
+        self.ancestor_values = None
+        
+        # Guards the cache and the preloaded arrays, which are shared by the
+        # threads that compare concepts
+        self._lock = threading.Lock()
+        
+        self.get_parent_ic_query = (
+            "SELECT h.subclass, MAX(t.{}) "
+            "FROM hierarchy AS h "
+            "JOIN {} AS t ON t.id = h.superclass "
+            "WHERE h.distance = 1 "
+            "GROUP BY h.subclass".format(column, table))
+        self.get_ancestor_ic_query = (
+            "SELECT h.subclass, MAX(t.{}) "
+            "FROM hierarchy AS h "
+            "JOIN {} AS t ON t.id = h.superclass "
+            "GROUP BY h.subclass".format(column, table))
+    
+    
+    def preload(self):
+        """
+        Reads the whole IC column into a dense array indexed by concept id,
+        with -1 for the concepts without IC. While `PRELOAD_IC` is set, `get`
+        reads the values from it instead of querying the database.
+        """
+        
+        with self._lock:
+            if self.values is None:
+                self.values = utils.load_dense_column(self.table,
+                                                      self.column)
+    
+    
+    def preload_parents(self):
+        """
+        Computes, for every concept, the maximum IC of its direct superclasses
+        into a dense array indexed by concept id, with 0 for the concepts
+        whose superclasses have no IC. If `PARENT_IC_TABLE` is set, the values
+        are read from that table, after storing them there if needed.
+        """
+        
+        with self._lock:
+            if self.parent_values is not None:
+                return
+            
+            if PARENT_IC_TABLE is None:
+                query, args = self.get_parent_ic_query, ()
+            else:
+                self.store_parents(PARENT_IC_TABLE)
+                query = ("SELECT id, ic FROM {} WHERE measure = %s"
+                         .format(PARENT_IC_TABLE))
+                args = (self.get_measure(),)
+            
+            self.parent_values = read_max_values(query, args)
+    
+    
+    def preload_ancestors(self):
+        """
+        Computes, for every concept, the maximum IC of all its superclasses,
+        in the same way as `preload_parents`. No common superclass of two
+        concepts can have more IC than this, so it bounds their shared IC.
+        """
+        
+        with self._lock:
+            if self.ancestor_values is None:
+                self.ancestor_values = read_max_values(
+                    self.get_ancestor_ic_query)
+    
+    
+    def get_measure(self):
+        return "{}.{}".format(self.table, self.column)
+    
+    
+    def get_parents_fingerprint(self):
+        # Any change to the direct superclasses or to the IC values of this
+        # measure is very likely to change at least one of these values
+        with sql.borrow() as cursor:
+            cursor.execute(
+                "SELECT COUNT(*), SUM(subclass), SUM(superclass) "
+                "FROM hierarchy "
+                "WHERE distance = 1")
+            row = cursor.fetchone()
+            cursor.execute("SELECT COUNT(*), SUM(id), SUM({}) FROM {}"
+                           .format(self.column, self.table))
+            row += cursor.fetchone()
+        return ":".join(str(value or 0) for value in row)
+    
+    
+    def store_parents(self, table):
+        # Fills the table with the values of this IC measure, unless it
+        # already has them. The fingerprint of the tables they were computed
+        # from is stored in another table, and the values are computed again
+        # whenever it changes
+        sql.assert_identifier(table)
+        fingerprints = table + "_fingerprints"
+        sql.assert_identifier(fingerprints)
+        
+        measure = self.get_measure()
+        fingerprint = self.get_parents_fingerprint()
+        with sql.borrow() as cursor:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS {} ("
+                "    measure VARCHAR(64) NOT NULL, "
+                "    id INT NOT NULL, "
+                "    ic DOUBLE, "
+                "    PRIMARY KEY (measure, id))".format(table))
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS {} ("
+                "    measure VARCHAR(64) NOT NULL, "
+                "    fingerprint VARCHAR(255) NOT NULL, "
+                "    PRIMARY KEY (measure))".format(fingerprints))
+            cursor.execute("SELECT fingerprint FROM {} WHERE measure = %s"
+                           .format(fingerprints), (measure,))
+            row = cursor.fetchone()
+            if row is not None and row[0] == fingerprint:
+                return
+            
+            if row is not None:
+                logging.info("The values of %s in %s are outdated",
+                             measure, table)
+            
+            cursor.execute("DELETE FROM {} WHERE measure = %s".format(table),
+                           (measure,))
+            cursor.execute(
+                "INSERT INTO {} (measure, id, ic) "
+                "SELECT %s, t.* FROM ({}) AS t"
+                .format(table, self.get_parent_ic_query), (measure,))
+            cursor.execute("DELETE FROM {} WHERE measure = %s"
+                           .format(fingerprints), (measure,))
+            cursor.execute("INSERT INTO {} (measure, fingerprint) "
+                           "VALUES (%s, %s)".format(fingerprints),
+                           (measure, fingerprint))
+            cursor.connection.commit()
+    
+    
+    def get_max_parent(self, concept):
+        """
+        Returns the maximum IC of the direct superclasses of the concept, or 0
+        if none of them has IC.
+        """
+        
+        self.preload_parents()
+        if 0 <= concept < len(self.parent_values):
+            return self.parent_values[concept]
+        return 0
+    
+    
+    def get_max_ancestor(self, concept):
+        """
+        Returns the maximum IC of the superclasses of the concept, or 0 if none
+        of them has IC.
+        """
+        
+        self.preload_ancestors()
+        if 0 <= concept < len(self.ancestor_values):
+            return self.ancestor_values[concept]
+        return 0
+    
+    
+    def get_values(self):
+        # Returns the dense array of IC values, if they are to be read from
+        # memory, and `None` otherwise
+        if snapshot.current is not None:
+            return snapshot.current.ic_values(self.table, self.column)
+        if PRELOAD_IC:
+            self.preload()
+            return self.values
+        return None
+    
+    
+    def get_many(self, concepts):
+        """
+        Returns a NumPy array with the IC of each of the given concepts.
+        """
+        
+        values = self.get_values()
+        if values is None:
+            return numpy.array([self.get(i) for i in concepts], dtype=float)
+        
+        values = numpy.frombuffer(values, dtype=float)
+        concepts = numpy.array(concepts, dtype=int)
+        inside = (concepts >= 0) & (concepts < len(values))
+        result = values[numpy.where(inside, concepts, 0)]
+        return numpy.where(inside, result, -1)
     
     
     def get(self, concept):
-        if concept in self._cache:
-            return self._cache[concept]
+        values = self.get_values()
+        if values is not None:
+            if 0 <= concept < len(values):
+                return values[concept]
+            return -1
+        
+        with self._lock:
+            if concept in self._cache:
+                return self._cache[concept]
         
-        with sql.lock:
-            sql.cursor.execute(self.get_ic_query, (concept,))
-            row = sql.cursor.fetchone()
+        with sql.borrow() as cursor:
+            cursor.execute(self.get_ic_query, (concept,))
+            row = cursor.fetchone()
         
         if row is None:
             result = -1
         else:
             result = row[0]
         
-        self._cache[concept] = result
+        with self._lock:
+            return self._cache.setdefault(concept, result)
+
+
+class AncestorCache(metaclass=ArgSingleton):
+    """
+    Stores, for each concept, its superclasses that have information content,
+    as a sorted array of ids, along with an array of their IC values. The
+    superclasses come from the `hierarchy` table or, if an extension is given,
+    from the corresponding extension of the `extended_hierarchy` table.
+    """
+    
+    def __init__(self, ic, hierarchy=None):
+        table, column = table_column_from_ic(ic)
+        
+        # The placeholder is replaced by the list of concepts to fetch
+        if hierarchy is None:
+            self.get_ancestors_query = (
+                "SELECT h.subclass, h.superclass, t.{column} "
+                "FROM hierarchy AS h "
+                "JOIN {table} AS t ON t.id = h.superclass "
+                "WHERE h.subclass IN ({{}}) "
+                "ORDER BY h.superclass"
+                .format(table=table, column=column))
+        else:
+            self.get_ancestors_query = (
+                "SELECT h.subclass, h.superclass, t.{column} "
+                "FROM extended_hierarchy AS h "
+                "JOIN {table} AS t ON t.id = h.superclass "
+                "WHERE h.subclass IN ({{}}) AND "
+                "      h.extension = {hierarchy} "
+                "ORDER BY h.superclass"
+                .format(table=table, column=column,
+                        hierarchy=sql.escape(hierarchy)))
+        
+        self._cache = {}
+        self._lock = threading.Lock()
+    
+    
+    def get(self, concept):
+        with self._lock:
+            if concept in self._cache:
+                return self._cache[concept]
+        return self.get_many([concept])[0]
+    
+    
+    def get_many(self, concepts, batch_size=1000):
+        """
+        Returns the cached superclasses of each of the given concepts. Those
+        that are not in the cache yet are fetched with a few batched queries.
+        """
+        
+        with self._lock:
+            todo = sorted({i for i in concepts if i not in self._cache})
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start + batch_size]
+            fetched = {i: (array('l'), array('d')) for i in batch}
+            
+            query = self.get_ancestors_query.format(
+                ', '.join(['%s'] * len(batch)))
+            with sql.borrow() as cursor:
+                cursor.execute(query, batch)
+                for concept, superclass, value in cursor:
+                    ancestors, values = fetched[concept]
+                    # Skip repeated superclasses and those without a value
+                    if value is None or (ancestors and
+                                         ancestors[-1] == superclass):
+                        continue
+                    ancestors.append(superclass)
+                    values.append(value)
+            
+            with self._lock:
+                # Another thread may have fetched some of them in the meantime
+                for concept, closure in fetched.items():
+                    self._cache.setdefault(concept, closure)
+        
+        with self._lock:
+            return [self._cache[i] for i in concepts]
+    
+    
+    def get_mica(self, one, two):
+        """
+        Returns a tuple with the most informative common ancestor of `one` and
+        `two` and its IC, or `None` if they have no common ancestor.
+        """
+        
+        ancestors_one, values_one = self.get(one)
+        ancestors_two, values_two = self.get(two)
+        
+        result = None
+        i = j = 0
+        while i < len(ancestors_one) and j < len(ancestors_two):
+            first = ancestors_one[i]
+            second = ancestors_two[j]
+            if first < second:
+                i += 1
+            elif first > second:
+                j += 1
+            else:
+                if result is None or values_one[i] > result[1]:
+                    result = first, values_one[i]
+                i += 1
+                j += 1
+        
+        return result
+
+
+# The number of rows of a matrix of shared IC values that are computed at once
+MATRIX_BLOCK_ROWS = 1024
+
+
+def index_columns(closures):
+    # Returns, for each ancestor in the given closures, a NumPy array with
+    # the positions of the closures that contain it
+    columns = defaultdict(list)
+    for index, (ancestors, values) in enumerate(closures):
+        for ancestor in ancestors:
+            columns[ancestor].append(index)
+    return {ancestor: numpy.array(indexes, dtype=int)
+            for ancestor, indexes in columns.items()}
+
+
+def max_shared_ic(closures_one, columns, size):
+    """
+    Given the superclasses of a list of concepts, as (ancestors, values)
+    tuples, and the index of the superclasses of another list of `size`
+    concepts (see `index_columns`), returns a matrix with the IC of the most
+    informative common ancestor of each pair of concepts, or -inf if the pair
+    has no common ancestor.
+    """
+    
+    result = numpy.full((len(closures_one), size), -numpy.inf)
+    for row, (ancestors, values) in zip(result, closures_one):
+        # The ancestors of each row are visited from the most informative
+        # one, and each only fills the cells that are still empty. The row is
+        # done as soon as all its cells have a value, which usually happens
+        # long before reaching the root
+        remaining = size
+        order = numpy.argsort(numpy.asarray(values, dtype=float))[::-1]
+        for position in order:
+            cells = columns.get(ancestors[position])
+            if cells is None:
+                continue
+            cells = cells[row[cells] == -numpy.inf]
+            row[cells] = values[position]
+            remaining -= len(cells)
+            if remaining == 0:
+                break
+    
+    return result
+
+
+def assert_numpy():
+    if numpy is None:
+        raise ImportError("Unable to import 'numpy', which is required to "
+                          "compare matrices of concepts")
+
+
+class DisjointIndex(metaclass=ArgSingleton):
+    """
+    For each pair of disjoint classes, stores the smallest sum of the
+    distances from both classes to one of their common superclasses. From
+    this, the disjointness factor of two concepts is found by looking at the
+    disjoint classes among their superclasses, without querying the database
+    for each pair.
+    """
+    
+    def __init__(self):
+        self.distances = defaultdict(dict)
+        with sql.borrow_streaming() as cursor:
+            cursor.execute(
+                "SELECT d.id1, d.id2, MIN(h1.distance + h2.distance) "
+                "FROM disjoints AS d "
+                "JOIN hierarchy AS h1 ON h1.subclass = d.id1 "
+                "JOIN hierarchy AS h2 ON h2.subclass = d.id2 AND "
+                "                        h2.superclass = h1.superclass "
+                "GROUP BY d.id1, d.id2")
+            for id1, id2, distance in cursor:
+                # Disjointness is symmetric, even if only one of the
+                # directions is in the table
+                for first, second in ((id1, id2), (id2, id1)):
+                    previous = self.distances[first].get(second)
+                    if previous is None or distance < previous:
+                        self.distances[first][second] = distance
+        
+        self.get_superclasses_query = (
+            "SELECT superclass FROM hierarchy WHERE subclass = %s")
+        self._superclasses = {}
+        self._partners = {}
+        self._lock = threading.Lock()
+    
+    
+    def get_superclasses(self, concept):
+        if snapshot.current is not None:
+            return set(snapshot.current.get_superclasses(concept))
+        
+        with self._lock:
+            if concept in self._superclasses:
+                return self._superclasses[concept]
+        
+        with sql.borrow() as cursor:
+            cursor.execute(self.get_superclasses_query, (concept,))
+            result = {row[0] for row in cursor}
+        
+        with self._lock:
+            return self._superclasses.setdefault(concept, result)
+    
+    
+    def get_partners(self, concept):
+        # The classes that are disjoint with some superclass of the concept,
+        # each with the smallest distance to one such superclass
+        with self._lock:
+            if concept in self._partners:
+                return self._partners[concept]
+        
+        result = {}
+        for superclass in self.get_superclasses(concept):
+            disjoint = self.distances.get(superclass, {})
+            for partner, distance in disjoint.items():
+                if partner not in result or distance < result[partner]:
+                    result[partner] = distance
+        
+        with self._lock:
+            return self._partners.setdefault(concept, result)
+    
+    
+    def get_distance(self, one, two):
+        """
+        Returns the same as `DisjointFactor.get_distance_query`: the smallest
+        distance between a superclass of `one` and a disjoint superclass of
+        `two`, through a common superclass of both, or `None` if there is none.
+        """
+        
+        partners = self.get_partners(one)
+        if not partners:
+            return None
+        
+        result = None
+        for superclass in self.get_superclasses(two):
+            distance = partners.get(superclass)
+            if distance is not None and (result is None or distance < result):
+                result = distance
         return result
 
 
@@ -82,9 +622,12 @@ class DisjointFactor:
     
     
     def get(self, one, two):
-        with sql.lock:
-            sql.cursor.execute(self.get_distance_query, (one, two, one, two))
-            factor = sql.cursor.fetchone()[0]
+        if INDEX_DISJOINTS:
+            factor = DisjointIndex().get_distance(one, two)
+        else:
+            with sql.borrow() as cursor:
+                cursor.execute(self.get_distance_query, (one, two, one, two))
+                factor = cursor.fetchone()[0]
         
         if factor is None:
             return 0
@@ -133,18 +676,348 @@ class SharedICCalculator:
                 "      t.id = e1.superclass AND "
                 "      e1.extension = {hierarchy} AND "
                 "      e2.extension = {hierarchy} "
-                "ORDER BY ic DESC LIMIT 1"
-                .format(table=table, hierarchy=sql.conn.escape(hierarchy)))
+                "ORDER BY t.{column} DESC LIMIT 1"
+                .format(table=table, column=column,
+                        hierarchy=sql.escape(hierarchy)))
         
         if not use_disjoints:
             self.use_disjoints = False
         else:
             self.use_disjoints = DisjointFactor()
         
+        # Computes everything that `lin` and `jiang` need for a list of pairs
+        # in a single statement. The pairs are given as a derived table, which
+        # is formatted into the query with one `SELECT %s, %s` for each pair.
+        columns = [
+            "(SELECT {column} FROM {table} WHERE id = p.one)",
+            "(SELECT {column} FROM {table} WHERE id = p.two)",
+            "(SELECT t.{column} "
+            " FROM hierarchy AS h1 "
+            " JOIN hierarchy AS h2 ON h2.superclass = h1.superclass "
+            " JOIN {table} AS t ON t.id = h1.superclass "
+            " WHERE h1.subclass = p.one AND h2.subclass = p.two "
+            " ORDER BY t.{column} DESC LIMIT 1)"]
+        if hierarchy is not None:
+            columns.append(
+                "(SELECT t.{column} "
+                " FROM extended_hierarchy AS e1 "
+                " JOIN extended_hierarchy AS e2 "
+                "   ON e2.superclass = e1.superclass "
+                " JOIN {table} AS t ON t.id = e1.superclass "
+                " WHERE e1.subclass = p.one AND e2.subclass = p.two AND "
+                "       e1.extension = {hierarchy} AND "
+                "       e2.extension = {hierarchy} "
+                " ORDER BY t.{column} DESC LIMIT 1)")
+        if use_disjoints:
+            # The disjointness correction also needs the MICA itself
+            mica = (
+                "(SELECT t.id "
+                " FROM hierarchy AS h1 "
+                " JOIN hierarchy AS h2 ON h2.superclass = h1.superclass "
+                " JOIN {table} AS t ON t.id = h1.superclass "
+                " WHERE h1.subclass = p.one AND h2.subclass = p.two "
+                " ORDER BY t.{column} DESC LIMIT 1)")
+            columns.append(mica)
+        
+        columns = [column_query.format(
+                       table=table, column=column,
+                       hierarchy=hierarchy and sql.escape(hierarchy))
+                   for column_query in columns]
+        
+        # The distances of `DisjointFactor`, in each direction, and the
+        # maximum IC of the superclasses of the MICA, as in `z_query`. They
+        # are only added when they are not kept in memory (see
+        # `get_combined_query`)
+        self.disjoint_columns = [
+            "(SELECT MIN(a.distance + b.distance) "
+            " FROM hierarchy AS h1 "
+            " JOIN hierarchy AS h2 ON h2.subclass = p.two "
+            " JOIN disjoints AS d "
+            "   ON d.id1 = {first}.superclass AND "
+            "      d.id2 = {second}.superclass "
+            " JOIN hierarchy AS a ON a.subclass = h1.superclass "
+            " JOIN hierarchy AS b ON b.subclass = h2.superclass AND "
+            "                       b.superclass = a.superclass "
+            " WHERE h1.subclass = p.one)".format(first=first, second=second)
+            for first, second in (("h1", "h2"), ("h2", "h1"))]
+        if use_disjoints:
+            self.z_column = (
+                "(SELECT MAX(t.{column}) "
+                " FROM hierarchy AS h "
+                " JOIN {table} AS t ON t.id = h.superclass "
+                " WHERE h.distance = 1 AND h.subclass = {mica})"
+                .format(table=table, column=column,
+                        mica=mica.format(table=table, column=column)))
+        
+        self.base_columns = columns
+        self.combined_queries = {}
+        
+        # Pairs in the pair cache are identified by this configuration and
+        # the two concepts
+        self.configuration = (ic, hierarchy, bool(use_disjoints))
+        
+        self.ancestor_cache = AncestorCache(ic)
+        if hierarchy is None:
+            self.xancestor_cache = None
+        else:
+            self.xancestor_cache = AncestorCache(ic, hierarchy)
+        
         self.ic_calculator = ICCalculator(ic)
     
     
+    def get_ic_values(self):
+        return self.ic_calculator.get_values()
+    
+    
+    def get_closures(self, concepts):
+        if snapshot.current is not None:
+            values = self.get_ic_values()
+            return [snapshot.current.get_ancestors(i, values)
+                    for i in concepts]
+        else:
+            return self.ancestor_cache.get_many(concepts)
+    
+    
+    def get_matrix(self, ones, twos):
+        """
+        Returns a matrix with the shared IC of each concept in `ones` with each
+        concept in `twos`, where both are lists of concept ids. The result is
+        the same as calling `.get` for each pair.
+        """
+        
+        assert_numpy()
+        
+        result = numpy.empty((len(ones), len(twos)))
+        for start, block in self.iter_matrix(ones, twos):
+            result[start:start + len(block)] = block
+        return result
+    
+    
+    def iter_matrix(self, ones, twos, block_rows=None):
+        """
+        Computes the same matrix as `get_matrix`, in blocks of at most
+        `block_rows` rows (by default, `MATRIX_BLOCK_ROWS`). Yields the index
+        of the first row of each block along with the block, so that large
+        matrices can be processed without keeping them whole in memory.
+        """
+        
+        assert_numpy()
+        
+        if block_rows is None:
+            block_rows = MATRIX_BLOCK_ROWS
+        
+        if not self.use_disjoints:
+            columns = index_columns(self.get_closures(twos))
+            if self.xancestor_cache is not None:
+                xcolumns = index_columns(self.xancestor_cache.get_many(twos))
+        
+        for start in range(0, len(ones), block_rows):
+            block = ones[start:start + block_rows]
+            
+            if self.use_disjoints:
+                # The disjointness correction depends on each pair
+                yield start, numpy.array(
+                    [[self.get(one, two) for two in twos] for one in block],
+                    dtype=float).reshape(len(block), len(twos))
+                continue
+            
+            result = max_shared_ic(self.get_closures(block), columns,
+                                   len(twos))
+            found = result != -numpy.inf
+            
+            if self.xancestor_cache is not None:
+                extended = max_shared_ic(self.xancestor_cache.get_many(block),
+                                         xcolumns, len(twos))
+                numpy.maximum(result, extended, out=result)
+            
+            # Pairs without a common ancestor in the regular hierarchy have no
+            # shared IC, even if they have one in the extended hierarchy
+            result[~found] = 0
+            yield start, result
+    
+    
+    def get_combined_query(self):
+        """
+        Returns the query for `get_combined`, along with whether it includes
+        the disjointness distances and the IC for the disjointness correction.
+        The values that are already kept in memory are not queried.
+        """
+        
+        with_distances = self.use_disjoints and not INDEX_DISJOINTS
+        with_z = self.use_disjoints and not (PRELOAD_PARENT_IC or
+                                             snapshot.current is not None)
+        
+        key = bool(with_distances), bool(with_z)
+        if key not in self.combined_queries:
+            columns = list(self.base_columns)
+            if with_distances:
+                columns.extend(self.disjoint_columns)
+            if with_z:
+                columns.append(self.z_column)
+            self.combined_queries[key] = (
+                "SELECT p.one, p.two, " + ", ".join(columns) +
+                " FROM ({pairs}) AS p")
+        
+        return self.combined_queries[key], key
+    
+    
+    def get_combined(self, pairs, batch_size=500):
+        """
+        Returns, for each (one, two) pair of concept ids, a tuple with the IC
+        of `one`, the IC of `two` and their shared IC, which is the same as
+        `.get(one, two)`. A single query is sent for each batch of pairs.
+        Concepts without IC get -1, as with `ICCalculator.get`.
+        """
+        
+        pairs = list(pairs)
+        combined_query, columns = self.get_combined_query()
+        results = {}
+        for start in range(0, len(pairs), batch_size):
+            batch = pairs[start:start + batch_size]
+            query = combined_query.format(pairs=" UNION ALL ".join(
+                ["SELECT %s AS one, %s AS two"] +
+                ["SELECT %s, %s"] * (len(batch) - 1)))
+            args = [concept for pair in batch for concept in pair]
+            
+            with sql.borrow() as cursor:
+                cursor.execute(query, args)
+                rows = cursor.fetchall()
+            
+            for row in rows:
+                results[row[0], row[1]] = self.combine(row, *columns)
+        
+        return [results[pair] for pair in pairs]
+    
+    
+    def combine(self, row, with_distances=False, with_z=False):
+        # Turns a row of the combined query into the values that
+        # `get_combined` returns
+        one, two, ic_one, ic_two, ic_mica, *rest = row
+        if ic_one is None:
+            ic_one = -1
+        if ic_two is None:
+            ic_two = -1
+        
+        if ic_mica is None:
+            return ic_one, ic_two, 0
+        
+        if self.get_xhierarchy_query:
+            ic_extended = rest.pop(0)
+            if ic_extended is not None and ic_extended > ic_mica:
+                ic_mica = ic_extended
+        
+        if self.use_disjoints:
+            mica = rest.pop(0)
+            
+            factor = None
+            if with_distances:
+                distances = [distance for distance in (rest.pop(0),
+                                                       rest.pop(0))
+                             if distance is not None]
+                factor = 1 / min(distances) if distances else 0
+            
+            ic_z = None
+            if with_z:
+                ic_z = rest.pop(0) or 0
+            
+            ic_mica = self.correct_disjoints(one, two, mica, ic_mica,
+                                             factor, ic_z)
+        
+        return ic_one, ic_two, ic_mica
+    
+    
+    def get_upper_bound(self, one, two):
+        """
+        Returns a value that the shared IC of the two concepts cannot exceed,
+        without finding their MICA, or `None` if there is no such bound. The
+        bound is the smallest of the maximum IC of the superclasses of each
+        concept. This includes the disjointness correction, which only moves
+        the value towards the IC of a superclass of the MICA. The extended
+        hierarchy has no such bound.
+        """
+        
+        if self.xancestor_cache is not None:
+            return None
+        
+        return min(self.ic_calculator.get_max_ancestor(one),
+                   self.ic_calculator.get_max_ancestor(two))
+    
+    
+    def get_many(self, pairs):
+        """
+        Returns the shared IC of each (one, two) pair of concept ids, the same
+        as calling `.get` for each pair. Without a snapshot or the ancestor
+        cache, the pairs are computed in batches with `get_combined`.
+        """
+        
+        if snapshot.current is not None or CACHE_ANCESTORS:
+            return [self.get(one, two) for one, two in pairs]
+        
+        if PAIR_CACHE is None:
+            return [shared for _, _, shared in self.get_combined(pairs)]
+        
+        keys = [self.get_key(one, two) for one, two in pairs]
+        results = [PAIR_CACHE.get(key) for key in keys]
+        missing = [index for index, result in enumerate(results)
+                   if result is None]
+        
+        values = self.get_combined([pairs[index] for index in missing])
+        for index, (_, _, shared) in zip(missing, values):
+            results[index] = shared
+            PAIR_CACHE.put(keys[index], shared)
+        
+        return results
+    
+    
+    def get_combined_many(self, pairs):
+        """
+        Returns the same as `get_combined`, but the shared IC of the pairs that
+        are in the pair cache is not computed again: only the IC of their
+        concepts is read. The other pairs are sent to `get_combined`, and their
+        shared IC is stored in the cache.
+        """
+        
+        if PAIR_CACHE is None:
+            return self.get_combined(pairs)
+        
+        keys = [self.get_key(one, two) for one, two in pairs]
+        cached = [PAIR_CACHE.get(key) for key in keys]
+        missing = [index for index, shared in enumerate(cached)
+                   if shared is None]
+        
+        results = dict(zip(missing, self.get_combined(
+            [pairs[index] for index in missing])))
+        for index in missing:
+            PAIR_CACHE.put(keys[index], results[index][2])
+        
+        return [results[index] if index in results else
+                (self.ic_calculator.get(one), self.ic_calculator.get(two),
+                 shared)
+                for index, ((one, two), shared)
+                in enumerate(zip(pairs, cached))]
+    
+    
+    def get_key(self, one, two):
+        # The shared IC is symmetric, so (one, two) and (two, one) share the
+        # same entry of the pair cache
+        if one <= two:
+            return self.configuration + (one, two)
+        return self.configuration + (two, one)
+    
+    
     def get(self, one, two):
+        if PAIR_CACHE is None:
+            return self.compute(one, two)
+        
+        key = self.get_key(one, two)
+        result = PAIR_CACHE.get(key)
+        if result is None:
+            result = self.compute(one, two)
+            PAIR_CACHE.put(key, result)
+        return result
+    
+    
+    def compute(self, one, two):
         # Note: If there is an extension hierarchy from a property that is
         # reflexive, this first part is irrelevant, as the same result will by
         # definition be obtained by querying only the extended hierarchy ...
@@ -152,40 +1025,70 @@ class SharedICCalculator:
         # alone. Maybe we should create a table that stores whether a given
         # extension is transitive and/or reflexive
         
-        with sql.lock:
-            sql.cursor.execute(self.get_mica_query, (one, two))
-            row = sql.cursor.fetchone()
+        if snapshot.current is not None:
+            mica = snapshot.current.get_mica(one, two, self.get_ic_values())
+            if mica is None:
+                return 0
+            ic_mica = self.ic_calculator.get(mica)
         
-        if row is None:
-            return 0
-    
-        mica = row[0]
-        ic_mica = self.ic_calculator.get(mica)
+        elif CACHE_ANCESTORS:
+            result = self.ancestor_cache.get_mica(one, two)
+            if result is None:
+                return 0
+            mica, ic_mica = result
+        
+        else:
+            with sql.borrow() as cursor:
+                cursor.execute(self.get_mica_query, (one, two))
+                row = cursor.fetchone()
+            if row is None:
+                return 0
+            mica = row[0]
+            ic_mica = self.ic_calculator.get(mica)
         
         if self.get_xhierarchy_query:
-            with sql.lock:
-                sql.cursor.execute(self.get_xhierarchy_query, (one, two))
-                row = sql.cursor.fetchone()
+            if snapshot.current is not None or CACHE_ANCESTORS:
+                result = self.xancestor_cache.get_mica(one, two)
+            else:
+                with sql.borrow() as cursor:
+                    cursor.execute(self.get_xhierarchy_query, (one, two))
+                    row = cursor.fetchone()
+                if row is None:
+                    result = None
+                else:
+                    result = row[0], self.ic_calculator.get(row[0])
             
-            if row is not None:
-                tmp_mica = row[0]
-                ic_tmp_mica = self.ic_calculator.get(tmp_mica)
-                if ic_tmp_mica > ic:
-                    mica, ic_mica = tmp_mica, ic_tmp_mica
+            if result is not None and result[1] > ic_mica:
+                mica, ic_mica = result
         
         # Note: Can we in any way use the extended hierarchy with the
         # disjointness theory?
         if not self.use_disjoints:
             return ic_mica
         
-        factor = self.use_disjoints.get(one, two)
+        return self.correct_disjoints(one, two, mica, ic_mica)
+    
+    
+    def correct_disjoints(self, one, two, mica, ic_mica, factor=None,
+                          ic_z=None):
+        # The disjointness factor and the IC of the most informative ancestor
+        # of the MICA are computed here, unless they are given
+        if factor is None:
+            factor = self.use_disjoints.get(one, two)
+        if ic_z is None:
+            ic_z = self.get_z(mica)
         
+        return ic_mica - factor * (ic_mica - ic_z)
+    
+    
+    def get_z(self, mica):
         # Find most informative ancestor of MICA
-        with sql.lock:
-            sql.cursor.execute(self.z_query, (mica,))
-            ic_z = sql.cursor.fetchone()[0] or 0
+        if PRELOAD_PARENT_IC or snapshot.current is not None:
+            return self.ic_calculator.get_max_parent(mica)
         
-        return ic_mica - factor * (ic_mica - ic_z)
+        with sql.borrow() as cursor:
+            cursor.execute(self.z_query, (mica,))
+            return cursor.fetchone()[0] or 0
 
 
 @plugin()
@@ -207,14 +1110,28 @@ class resnik:
     
     Usage:
         .compare(one, two)
+        .compare_many(pairs)
+        .compare_matrix(ones, twos)
+        .upper_bound(one, two)
     where
         `one` and `two` are concepts
+        `pairs` is a sequence of (one, two) pairs of concepts; the result is
+            the list of their comparisons
+        `ones` and `twos` are sequences of concepts; the result is a NumPy
+            matrix with the comparison of each concept in `ones` with each
+            concept in `twos` (this requires NumPy)
+    
+    `upper_bound` returns a value that `.compare(one, two)` cannot exceed,
+    which is much cheaper to compute, or `None` if `hierarchy` is given.
     
     Resnik is a classic semantic similarity method. See Resnik P. (1995). Using
     information content to evaluate semantic similarity in a taxonomy. arXiv
     preprint cmp-lg/9511007.
     """
     
+    symmetric = True
+    
+    
     def __init__(self, ic, hierarchy=None, use_disjoints=False):
         self.shared_ic_calculator = SharedICCalculator(
             ic, hierarchy, use_disjoints)
@@ -225,6 +1142,23 @@ class resnik:
         two = utils.get_id(two)
         
         return self.shared_ic_calculator.get(one, two)
+    
+    
+    def compare_many(self, pairs):
+        pairs = [(utils.get_id(one), utils.get_id(two)) for one, two in pairs]
+        return self.shared_ic_calculator.get_many(pairs)
+    
+    
+    def upper_bound(self, one, two):
+        return self.shared_ic_calculator.get_upper_bound(
+            utils.get_id(one), utils.get_id(two))
+    
+    
+    def compare_matrix(self, ones, twos):
+        ones = [utils.get_id(i) for i in ones]
+        twos = [utils.get_id(i) for i in twos]
+        
+        return self.shared_ic_calculator.get_matrix(ones, twos)
 
 
 @plugin()
@@ -246,20 +1180,57 @@ class lin:
     
     Usage:
         .compare(one, two)
+        .compare_many(pairs)
+        .compare_matrix(ones, twos)
+        .upper_bound(one, two)
     where
         `one` and `two` are concepts
+        `pairs` is a sequence of (one, two) pairs of concepts; the result is
+            the list of their comparisons
+        `ones` and `twos` are sequences of concepts; the result is a NumPy
+            matrix with the comparison of each concept in `ones` with each
+            concept in `twos` (this requires NumPy)
+    
+    `upper_bound` returns a value that `.compare(one, two)` cannot exceed,
+    which is much cheaper to compute, or `None` if `hierarchy` is given.
     
     Lin is a classic semantic similarity method. See Lin D. (1998). An
     information-theoretic definition of similarity. In ICML (Vol. 98, pp.
     296-304).
     """
     
+    symmetric = True
+    
+    
     def __init__(self, ic, hierarchy=None, use_disjoints=False):
         self.ic_calculator = ICCalculator(ic)
         self.shared_ic_calculator = SharedICCalculator(
             ic, hierarchy, use_disjoints)
     
     
+    def compare_many(self, pairs):
+        pairs = [(utils.get_id(one), utils.get_id(two)) for one, two in pairs]
+        values = get_pair_values(self, pairs)
+        return [1 if one == two else self.from_values(one, two, *value)
+                for (one, two), value in zip(pairs, values)]
+    
+    
+    def upper_bound(self, one, two):
+        if one == two:
+            return 1
+        
+        one = utils.get_id(one)
+        two = utils.get_id(two)
+        
+        shared_ic = self.shared_ic_calculator.get_upper_bound(one, two)
+        if shared_ic is None:
+            return None
+        
+        ic_one = self.ic_calculator.get(one)
+        ic_two = self.ic_calculator.get(two)
+        return self.from_values(one, two, ic_one, ic_two, shared_ic)
+    
+    
     def compare(self, one, two):
         if one == two:
             return 1
@@ -267,8 +1238,18 @@ class lin:
         one = utils.get_id(one)
         two = utils.get_id(two)
         
+        if use_combined_queries():
+            ic_one, ic_two, shared_ic = \
+                self.shared_ic_calculator.get_combined_many([(one, two)])[0]
+            return self.from_values(one, two, ic_one, ic_two, shared_ic)
+        
         ic_one = self.ic_calculator.get(one)
         ic_two = self.ic_calculator.get(two)
+        return self.from_values(one, two, ic_one, ic_two)
+    
+    
+    def from_values(self, one, two, ic_one, ic_two, shared_ic=None):
+        # The shared IC is computed here if it is not given
         
         # Special cases
         if ic_one == -1 or ic_two == -1:
@@ -279,9 +1260,24 @@ class lin:
             # We say, in this case, that similarity is 0
             return 0
         
-        num = 2 * self.shared_ic_calculator.get(one, two)
+        if shared_ic is None:
+            shared_ic = self.shared_ic_calculator.get(one, two)
+        
+        num = 2 * shared_ic
         den = ic_one + ic_two
         return num / den
+    
+    
+    def compare_matrix(self, ones, twos):
+        ones, twos, ic_ones, ic_twos, shared = get_matrix_arguments(
+            self, ones, twos)
+        
+        den = ic_ones + ic_twos
+        valid = (ic_ones != -1) & (ic_twos != -1) & (den != 0)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            result = numpy.where(valid, 2 * shared / den, 0)
+        
+        return numpy.where(ones == twos, 1, result)
 
 
 @plugin()
@@ -303,8 +1299,15 @@ class jiang:
     
     Usage:
         .compare(one, two)
+        .compare_many(pairs)
+        .compare_matrix(ones, twos)
     where
         `one` and `two` are concepts
+        `pairs` is a sequence of (one, two) pairs of concepts; the result is
+            the list of their comparisons
+        `ones` and `twos` are sequences of concepts; the result is a NumPy
+            matrix with the comparison of each concept in `ones` with each
+            concept in `twos` (this requires NumPy)
     
     Jiang & Conrath is a classic semantic distance method. It computes a
     distance rather than a similarity measure. See Jiang JJ, Conrath DW (1997).
@@ -312,12 +1315,22 @@ class jiang:
     preprint cmp-lg/9709008.
     """
     
+    symmetric = True
+    
+    
     def __init__(self, ic, hierarchy=None, use_disjoints=False):
         self.ic_calculator = ICCalculator(ic)
         self.shared_ic_calculator = SharedICCalculator(
             ic, hierarchy, use_disjoints)
     
     
+    def compare_many(self, pairs):
+        pairs = [(utils.get_id(one), utils.get_id(two)) for one, two in pairs]
+        values = get_pair_values(self, pairs)
+        return [0 if one == two else self.from_values(one, two, *value)
+                for (one, two), value in zip(pairs, values)]
+    
+    
     def compare(self, one, two):
         if one == two:
             return 0
@@ -325,8 +1338,18 @@ class jiang:
         one = utils.get_id(one)
         two = utils.get_id(two)
         
+        if use_combined_queries():
+            ic_one, ic_two, shared_ic = \
+                self.shared_ic_calculator.get_combined_many([(one, two)])[0]
+            return self.from_values(one, two, ic_one, ic_two, shared_ic)
+        
         ic_one = self.ic_calculator.get(one)
         ic_two = self.ic_calculator.get(two)
+        return self.from_values(one, two, ic_one, ic_two)
+    
+    
+    def from_values(self, one, two, ic_one, ic_two, shared_ic=None):
+        # The shared IC is computed here if it is not given
         
         # Special cases
         if ic_one == -1 or ic_two == -1:
@@ -337,5 +1360,52 @@ class jiang:
             # We say, in this case, that distance is 1
             return 1
         
-        shared_ic = self.shared_ic_calculator.get(one, two)
+        if shared_ic is None:
+            shared_ic = self.shared_ic_calculator.get(one, two)
+        
         return (ic_one + ic_two - 2 * shared_ic) / 2
+    
+    
+    def compare_matrix(self, ones, twos):
+        ones, twos, ic_ones, ic_twos, shared = get_matrix_arguments(
+            self, ones, twos)
+        
+        valid = (ic_ones != -1) & (ic_twos != -1) & (ic_ones + ic_twos != 0)
+        result = numpy.where(valid, (ic_ones + ic_twos - 2 * shared) / 2, 1)
+        
+        return numpy.where(ones == twos, 0, result)
+
+
+def get_pair_values(comparer, pairs):
+    # Returns the values needed by the `compare_many` method of `lin` and
+    # `jiang`: a tuple with the IC of both concepts and their shared IC for
+    # each pair. The shared IC goes through the pair cache, and the IC of
+    # each concept is read as in `.compare`
+    shared_ic_calculator = comparer.shared_ic_calculator
+    if use_combined_queries():
+        return shared_ic_calculator.get_combined_many(pairs)
+    
+    ic_calculator = comparer.ic_calculator
+    shared = shared_ic_calculator.get_many(pairs)
+    return [(ic_calculator.get(one), ic_calculator.get(two), value)
+            for (one, two), value in zip(pairs, shared)]
+
+
+def get_matrix_arguments(comparer, ones, twos):
+    # Returns the values needed by the `compare_matrix` method of `lin` and
+    # `jiang`: the concept ids as a column and a row vector, their ICs with
+    # the same shapes, and the matrix of shared IC values
+    assert_numpy()
+    
+    ones = [utils.get_id(i) for i in ones]
+    twos = [utils.get_id(i) for i in twos]
+    shared = comparer.shared_ic_calculator.get_matrix(ones, twos)
+    
+    ic_ones = comparer.ic_calculator.get_many(ones)
+    ic_twos = comparer.ic_calculator.get_many(twos)
+    
+    return (numpy.array(ones, dtype=int).reshape(-1, 1),
+            numpy.array(twos, dtype=int).reshape(1, -1),
+            ic_ones.reshape(-1, 1),
+            ic_twos.reshape(1, -1),
+            shared)
@@ -1,12 +1,129 @@
+import bisect
+import heapq
 import logging
 import math
 import sys
 
+from array import array
 from collections import defaultdict
 
 from mossy import sql, utils
 from mossy.parse_config import plugin
-from mossy.plugins.concept_comparers import ICCalculator
+from mossy.plugins.concept_comparers import ArgSingleton, ICCalculator
+
+# If set to True, the existential relations and the class-subclass hierarchy
+# are read into memory the first time a comparer is created, and the
+# neighborhoods are constructed without querying the database
+PRELOAD_RELATIONS = False
+
+
+# If set to an `utils.LRUCache`, the neighborhoods of the most recently
+# compared items are kept in memory, so they are not constructed again when
+# the same items are compared with others. See `set_neighborhood_cache`
+NEIGHBORHOOD_CACHE = None
+
+def set_neighborhood_cache(size):
+    """
+    Remembers the neighborhoods of the `size` most recently compared items.
+    With `None`, nothing is cached.
+    """
+    
+    global NEIGHBORHOOD_CACHE
+    if size is None:
+        NEIGHBORHOOD_CACHE = None
+    else:
+        NEIGHBORHOOD_CACHE = utils.LRUCache(size)
+    return NEIGHBORHOOD_CACHE
+
+
+class Edges:
+    """
+    The edges of a graph in compressed sparse row format: the edges that
+    start at node `n` are in the range `offsets[n]:offsets[n + 1]` of the
+    arrays `targets` and `distances` (and `chains`, if the edges have chains),
+    sorted by distance.
+    """
+    
+    def __init__(self, size, rows, get_chain=None):
+        self.offsets = offsets = array('l', [0]) * (size + 1)
+        self.targets = array('l')
+        self.distances = array('l')
+        self.chains = array('l') if get_chain is not None else None
+        
+        # The rows must be sorted by start node and distance
+        for row in rows:
+            start, target, distance = row[:3]
+            offsets[start + 1] += 1
+            self.targets.append(target)
+            self.distances.append(distance)
+            if get_chain is not None:
+                self.chains.append(get_chain(row[3]))
+        
+        for index in range(1, len(offsets)):
+            offsets[index] += offsets[index - 1]
+    
+    
+    def get_range(self, node, max_distance, min_distance=0):
+        """
+        Returns the range of the edges that start at the node and whose
+        distance is between `min_distance` and `max_distance`.
+        """
+        
+        if not 0 <= node < len(self.offsets) - 1:
+            return 0, 0
+        
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return (bisect.bisect_left(self.distances, min_distance, start, end),
+                bisect.bisect_right(self.distances, max_distance, start, end))
+
+
+class RelationsGraph(metaclass=ArgSingleton):
+    """
+    An in-memory copy of the existential relations and of the class-subclass
+    hierarchy. The chain of properties of each relation is parsed only once:
+    the relations refer to their chain by its position in `chains`. The edges
+    from each concept to its subclasses are only loaded if some comparer
+    needs them.
+    """
+    
+    def __init__(self):
+        with sql.borrow() as cursor:
+            cursor.execute("SELECT MAX(id) FROM owl_objects")
+            self.size = (cursor.fetchone()[0] or 0) + 1
+        
+        self.chains = []
+        chain_ids = {}
+        def get_chain(text):
+            index = chain_ids.get(text)
+            if index is None:
+                index = chain_ids[text] = len(self.chains)
+                self.chains.append(tuple(int(i) for i in text.split(',')))
+            return index
+        
+        self.relations = self.load_edges(
+            "SELECT start, end, distance, chain "
+            "FROM existential_relations "
+            "ORDER BY start, distance", get_chain)
+        self.superclasses = self.load_edges(
+            "SELECT subclass, superclass, distance "
+            "FROM hierarchy "
+            "ORDER BY subclass, distance")
+        self.subclasses = None
+    
+    
+    def load_edges(self, query, get_chain=None):
+        with sql.borrow_streaming() as cursor:
+            cursor.execute(query)
+            return Edges(self.size, cursor, get_chain)
+    
+    
+    def get_subclasses(self):
+        if self.subclasses is None:
+            self.subclasses = self.load_edges(
+                "SELECT superclass, subclass, distance "
+                "FROM hierarchy "
+                "ORDER BY superclass, distance")
+        return self.subclasses
 
 
 def chain_to_ids(chain):
@@ -29,8 +146,9 @@ def convert_input(item):
     # Concepts and properties are strings that represent their IRI
     # Any number of properties (including 0) is valid
     
-    # Convert concepts to chains
-    if type(item) == str:
+    # Convert concepts to chains. Compiled items (see `utils.compile_item`)
+    # have ids instead of IRIs, which are also accepted
+    if isinstance(item, (str, int)):
         chains = [[item]]
     
     else:
@@ -54,16 +172,16 @@ class LogScale:
     def get_weights(self):
         result = {}
         
-        with sql.lock:
-            sql.cursor.execute("SELECT COUNT(*) FROM existential_relations")
-            log_total = math.log(sql.cursor.fetchone()[0])
+        with sql.borrow() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM existential_relations")
+            log_total = math.log(cursor.fetchone()[0])
             
-            sql.cursor.execute(
+            cursor.execute(
                 "SELECT chain, COUNT(*) "
                 "FROM existential_relations "
                 "WHERE distance = 1 "
                 "GROUP BY chain")
-            for prop_id, count in sql.cursor:
+            for prop_id, count in cursor:
                 weight = 1 - math.log(count) / log_total
                 result[int(prop_id)] = self.min + (self.max - self.min) * weight
         
@@ -73,6 +191,9 @@ class LogScale:
 @plugin()
 class ferreira:
     
+    symmetric = True
+    
+    
     def __init__(self, *,
                  ic=None,
                  distance_threshold=3,
@@ -108,6 +229,24 @@ class ferreira:
         else:
             self.ic_calculator = None
         
+        # Everything that changes the neighborhood of an item. The
+        # neighborhood cache is shared by all the comparers, so this is part
+        # of the key of each entry
+        self.configuration = (distance_threshold, weight_threshold,
+                              frozenset(self.property_weights.items()),
+                              self.default_weight, discover_subclasses,
+                              ic or None)
+        
+        if PRELOAD_RELATIONS:
+            # The weight of each chain of properties is computed only once
+            self.graph = RelationsGraph()
+            self.chain_weights = array('d', (self.get_properties_weight(chain)
+                                             for chain in self.graph.chains))
+            if discover_subclasses:
+                self.graph.get_subclasses()
+        else:
+            self.graph = None
+        
         self.get_relations_query = (
             "SELECT chain, end, distance "
             "FROM existential_relations "
@@ -136,14 +275,33 @@ class ferreira:
         two = convert_input(two)
         
         logging.debug("Constructing neighborhood for first item")
-        n1 = self.construct_neighborhood(one)
+        n1 = self.get_neighborhood(one)
         
         logging.debug("Constructing neighborhood for second item")
-        n2 = self.construct_neighborhood(two)
+        n2 = self.get_neighborhood(two)
         
         return self.inter(n1, n2) / self.union(n1, n2)
     
     
+    def compare_many(self, pairs):
+        # The neighborhood of each distinct item is constructed only once, no
+        # matter how many pairs it appears in
+        neighborhoods = {}
+        def get_neighborhood(item):
+            chains = convert_input(item)
+            key = tuple(tuple(chain) for chain in chains)
+            if key not in neighborhoods:
+                neighborhoods[key] = self.get_neighborhood(chains)
+            return neighborhoods[key]
+        
+        results = []
+        for one, two in pairs:
+            n1 = get_neighborhood(one)
+            n2 = get_neighborhood(two)
+            results.append(self.inter(n1, n2) / self.union(n1, n2))
+        return results
+    
+    
     def inter(self, n1, n2):
         result = 0
         for concept_id, weight1 in n1.items():
@@ -162,6 +320,20 @@ class ferreira:
         return result
     
     
+    def get_neighborhood(self, chains):
+        if NEIGHBORHOOD_CACHE is None:
+            return self.construct_neighborhood(chains)
+        
+        key = self.configuration, tuple(tuple(chain) for chain in chains)
+        neighborhood = NEIGHBORHOOD_CACHE.get(key)
+        if neighborhood is None:
+            # Store a plain dictionary, so that looking up missing concepts
+            # never adds them to the cached neighborhood
+            neighborhood = dict(self.construct_neighborhood(chains))
+            NEIGHBORHOOD_CACHE.put(key, neighborhood)
+        return neighborhood
+    
+    
     def construct_neighborhood(self, chains):
         result = defaultdict(float)
         for chain in chains:
@@ -204,50 +376,113 @@ class ferreira:
                         self.get_ic(chain[-1]))
         
         # Each item in the todo list is a tuple:
-        #   (concept_id, length to get here, weight of the chain to get here)
+        #   (-weight of the chain to get here, length to get here, concept_id)
         # where the length is the number of properties. Once we reach a tuple
         # that is beyond the thresholds for this comparer we discard it.
-        todo = [(chain[-1], len(chain) - 1, chain_weight)]
+        #
+        # The tuples are expanded in order of decreasing weight. A tuple is
+        # dominated by an expanded tuple of the same concept with a greater or
+        # equal weight and a smaller or equal length: whatever can be reached
+        # from it can also be reached from the other one with at least the
+        # same weight, so it is not expanded again. This way each concept is
+        # expanded at most once for each Pareto-optimal (length, weight) pair
+        todo = [(-chain_weight, len(chain) - 1, chain[-1])]
+        expanded = defaultdict(list)
+        
+        def is_dominated(concept_id, distance, weight):
+            return any(other_distance <= distance and other_weight >= weight
+                       for other_distance, other_weight
+                       in expanded.get(concept_id, ()))
         
         while todo:
-            concept_id, prev_distance, prev_weight = todo.pop()
+            prev_weight, prev_distance, concept_id = heapq.heappop(todo)
+            prev_weight = -prev_weight
+            if is_dominated(concept_id, prev_distance, prev_weight):
+                continue
+            expanded[concept_id].append((prev_distance, prev_weight))
             
             result[concept_id] = max(result[concept_id], prev_weight)
             
             max_distance = self.distance_threshold - prev_distance
-            with sql.lock:
-                sql.cursor.execute(self.get_relations_query,
-                                   (concept_id, max_distance))
-                for props, end, distance in sql.cursor:
-                    props = [int(i) for i in props.split(',')]
-                    current_weight = (prev_weight *
-                                      self.get_properties_weight(props))
-                    current_distance = prev_distance + distance
-                    
-                    if (current_distance <= self.distance_threshold
-                            and current_weight >= self.weight_threshold):
-                        todo.append((end, current_distance, current_weight))
-        
-                if not self.property_weights[None]:
-                    continue
-                
-                if self.discover_subclasses:
-                    args = (concept_id, concept_id, max_distance)
-                else:
-                    args = (concept_id, max_distance)
-                sql.cursor.execute(self.get_hierarchy_query, args)
-                
-                for relative, distance in sql.cursor:
-                    current_distance = prev_distance + distance
-                    current_weight = prev_weight * self.property_weights[None] ** distance
-                    if (current_distance <= self.distance_threshold
-                            and current_weight >= self.weight_threshold):
-                        todo.append((relative,
-                                    current_distance,
-                                    current_weight))
+            for relative, distance, factor in self.get_neighbors(
+                    concept_id, max_distance):
+                current_distance = prev_distance + distance
+                current_weight = prev_weight * factor
+                if (current_distance <= self.distance_threshold
+                        and current_weight >= self.weight_threshold
+                        and not is_dominated(relative, current_distance,
+                                             current_weight)):
+                    heapq.heappush(todo, (-current_weight, current_distance,
+                                          relative))
         
         return result
-                    
+    
+    
+    def get_neighbors(self, concept_id, max_distance):
+        """
+        Returns the concepts that can be reached from the given one within
+        `max_distance`, through existential relations or the hierarchy, as a
+        list of (concept, distance, weight factor) tuples.
+        """
+        
+        if self.graph is not None:
+            return self.get_preloaded_neighbors(concept_id, max_distance)
+        
+        neighbors = []
+        with sql.borrow() as cursor:
+            cursor.execute(self.get_relations_query,
+                           (concept_id, max_distance))
+            for props, end, distance in cursor:
+                props = [int(i) for i in props.split(',')]
+                neighbors.append(
+                    (end, distance, self.get_properties_weight(props)))
+            
+            hierarchy_weight = self.property_weights[None]
+            if not hierarchy_weight:
+                return neighbors
+            
+            if self.discover_subclasses:
+                args = (concept_id, concept_id, max_distance)
+            else:
+                args = (concept_id, max_distance)
+            cursor.execute(self.get_hierarchy_query, args)
+            
+            for relative, distance in cursor:
+                neighbors.append(
+                    (relative, distance, hierarchy_weight ** distance))
+        
+        return neighbors
+    
+    
+    def get_preloaded_neighbors(self, concept_id, max_distance):
+        # The same as the queries in `get_neighbors`, but with the edges of
+        # the graph in memory
+        relations = self.graph.relations
+        start, end = relations.get_range(concept_id, max_distance)
+        neighbors = [(relations.targets[index],
+                      relations.distances[index],
+                      self.chain_weights[relations.chains[index]])
+                     for index in range(start, end)]
+        
+        hierarchy_weight = self.property_weights[None]
+        if not hierarchy_weight:
+            return neighbors
+        
+        if self.discover_subclasses:
+            # Only the direct superclasses, but all the subclasses
+            ranges = [(self.graph.superclasses, 1, 1),
+                      (self.graph.subclasses, max_distance, 0)]
+        else:
+            ranges = [(self.graph.superclasses, max_distance, 0)]
+        
+        for edges, high, low in ranges:
+            start, end = edges.get_range(concept_id, high, low)
+            for index in range(start, end):
+                distance = edges.distances[index]
+                neighbors.append((edges.targets[index], distance,
+                                  hierarchy_weight ** distance))
+        
+        return neighbors
     
     
     def get_properties_weight(self, props):
@@ -1,8 +1,343 @@
 import logging
 import sys
+import threading
+import weakref
+
+from array import array
+from collections import defaultdict
 
 from mossy import sql, utils
 from mossy.parse_config import plugin
+from mossy.plugins.concept_comparers import ICCalculator
+
+
+# If set to True, the superclasses of each item are read from the database
+# only once and kept in memory, and the comparisons are computed from them
+# without querying the database
+CACHE_CLOSURES = False
+
+# If set to a number, the comparisons where an item has at least this many
+# concepts load the ids into temporary tables, instead of writing them into
+# the text of the queries
+STAGING_SIZE = None
+
+# Each connection has one temporary table for each side of the comparisons,
+# since MySQL cannot refer to a temporary table twice in the same query. The
+# items are stored by number, and kept until there are too many of them
+STAGING_TABLES = ("mossy_staging_one", "mossy_staging_two")
+MAX_STAGED_ITEMS = 10000
+staged_items = weakref.WeakKeyDictionary()
+
+
+def get_id_strings(one, two):
+    return to_id_strings(one), to_id_strings(two)
+
+
+def to_id_strings(item):
+    # If only one concept is given, encapsulate it into a list. We need to
+    # convert to strings since we will build a query string from these ids
+    return [str(i) for i in utils.seq_to_ids(utils.to_seq(item))]
+
+
+def run_batch(queries, batch_size=100):
+    # Runs many queries that return a single value each and returns a list
+    # with those values. Instead of sending each query on its own, each batch
+    # of queries is sent as a single statement, where each query is a scalar
+    # subquery in one of the rows
+    results = []
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        query = " UNION ALL ".join(
+            "SELECT {}, ({})".format(index, query)
+            for index, query in enumerate(batch))
+        with sql.borrow() as cursor:
+            cursor.execute(query)
+            values = dict(cursor.fetchall())
+        results.extend(values[index] for index in range(len(batch)))
+    
+    return results
+
+
+def use_staging(comparer, one, two):
+    # The queries of the extended hierarchies use each side twice
+    return (STAGING_SIZE is not None and comparer.hierarchy is None and
+            max(len(one), len(two)) >= STAGING_SIZE)
+
+
+def stage(cursor, side, concepts):
+    # Stores the concepts (id strings) in the temporary table of the given
+    # side, unless they are already there, and returns a query that selects
+    # them
+    table = STAGING_TABLES[side]
+    items = staged_items.get(cursor)
+    if items is None:
+        for name in STAGING_TABLES:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE IF NOT EXISTS {} ("
+                "    item INT NOT NULL, "
+                "    concept INT NOT NULL, "
+                "    PRIMARY KEY (item, concept))".format(name))
+            cursor.execute("DELETE FROM {}".format(name))
+        items = staged_items[cursor] = ({}, {})
+    
+    key = frozenset(concepts)
+    item = items[side].get(key)
+    if item is None:
+        if len(items[side]) >= MAX_STAGED_ITEMS:
+            cursor.execute("DELETE FROM {}".format(table))
+            items[side].clear()
+        
+        item = len(items[side])
+        cursor.executemany(
+            "INSERT INTO {} (item, concept) VALUES (%s, %s)".format(table),
+            [(item, int(concept)) for concept in key])
+        items[side][key] = item
+    
+    return "SELECT concept FROM {} WHERE item = {}".format(table, item)
+
+
+def run_staged(comparer, one, two):
+    # Runs the intersection and union queries of the comparer with the
+    # concepts of both sides loaded into the temporary tables. The text of
+    # the queries does not depend on the number of concepts
+    with sql.borrow() as cursor:
+        one = stage(cursor, 0, one)
+        two = stage(cursor, 1, two)
+        
+        cursor.execute(comparer.inter_query.format(one, two))
+        inter = cursor.fetchone()[0]
+        cursor.execute(comparer.union_query.format(
+            "{} UNION {}".format(one, two)))
+        union = cursor.fetchone()[0]
+    
+    return inter, union
+
+
+class Closure:
+    # The superclasses of the concepts of an item, as a sorted array of ids,
+    # along with the weight of each superclass and the sum of all weights
+    
+    def __init__(self, weights):
+        self.ids = array('l', sorted(weights))
+        self.weights = array('d', (weights[i] for i in self.ids))
+        self.total = sum(self.weights)
+
+
+def intersect(one, two):
+    # Returns a dictionary with the weights of the superclasses that are in
+    # both closures. Both are sorted, so we can intersect them by merging
+    i, end_i = 0, len(one.ids)
+    j, end_j = 0, len(two.ids)
+    
+    common = {}
+    while i < end_i and j < end_j:
+        first = one.ids[i]
+        second = two.ids[j]
+        if first < second:
+            i += 1
+        elif first > second:
+            j += 1
+        else:
+            common[first] = one.weights[i]
+            i += 1
+            j += 1
+    
+    return common
+
+
+class ClosureCache:
+    """
+    Keeps in memory the superclasses of each item that has been compared,
+    after filtering them by relevance, so that they are read from the
+    database only once. Each superclass is weighted by the value of
+    `weight`, a column of the table `table` (or a constant if `table` is
+    `None`); superclasses without a value get a weight of 0.
+    """
+    
+    def __init__(self, weight, table=None, hierarchy=None, relevance=None,
+                 threshold=None):
+        self.hierarchy = hierarchy
+        self.closures = {}
+        self._lock = threading.Lock()
+        
+        query = "SELECT DISTINCT h.superclass, {} FROM {{}} AS h ".format(
+            weight)
+        if table is not None:
+            query += "LEFT JOIN {} AS t ON t.id = h.superclass ".format(table)
+        if relevance is not None:
+            query += "JOIN relevance ON relevance.id = h.superclass "
+        query += "WHERE h.subclass IN ({{0}}) "
+        if relevance is not None:
+            query += ("AND relevance.{} >= {} "
+                      .format(relevance, sql.escape(threshold)))
+        
+        self.plain_query = query.format("hierarchy")
+        if hierarchy is not None:
+            self.extended_query = (
+                query.format("extended_hierarchy") +
+                "AND h.extension = {}".format(sql.escape(hierarchy)))
+    
+    
+    def read_weights(self, query, concepts):
+        query = query.format(','.join(concepts))
+        with sql.borrow() as cursor:
+            cursor.execute(query)
+            return {superclass: weight or 0
+                    for superclass, weight in cursor.fetchall()}
+    
+    
+    def get(self, concepts):
+        """
+        Returns the closures of the given concepts (a list of id strings) in
+        the regular hierarchy, in the extended hierarchy (`None` if no
+        extended hierarchy is used) and in both of them.
+        """
+        
+        key = frozenset(concepts)
+        with self._lock:
+            closures = self.closures.get(key)
+        if closures is not None:
+            return closures
+        
+        weights = self.read_weights(self.plain_query, key)
+        plain = Closure(weights)
+        if self.hierarchy is None:
+            closures = plain, None, plain
+        else:
+            extended_weights = self.read_weights(self.extended_query, key)
+            extended = Closure(extended_weights)
+            weights.update(extended_weights)
+            closures = plain, extended, Closure(weights)
+        
+        with self._lock:
+            return self.closures.setdefault(key, closures)
+    
+    
+    def get_inter_union(self, one, two):
+        """
+        Returns the sum of the weights of the superclasses shared by `one` and
+        `two`, and the sum of the weights of all their superclasses.
+        """
+        
+        plain_one, extended_one, all_one = self.get(one)
+        plain_two, extended_two, all_two = self.get(two)
+        
+        common = intersect(plain_one, plain_two)
+        if self.hierarchy is None:
+            inter = sum(common.values())
+            union = all_one.total + all_two.total - inter
+        else:
+            common.update(intersect(extended_one, extended_two))
+            inter = sum(common.values())
+            union = (all_one.total + all_two.total -
+                     sum(intersect(all_one, all_two).values()))
+        
+        return inter, union
+    
+    
+    def join(self, items, threshold, min_ic=None, ic_values=None):
+        """
+        Returns a sorted list with the (index, index, similarity) triples of
+        the pairs of items whose similarity is at least `threshold`, which
+        must be positive. Each item is paired with itself and with the items
+        that come after it.
+        
+        Only the pairs that share some informative superclass are found
+        through an inverted index from each superclass to the items that have
+        it. The IC of each superclass is read from `ic_values`, a dense array
+        indexed by id, or is its weight if `ic_values` is `None`. Superclasses
+        without IC, such as the root, are shared by most items, so they are
+        left out of the index; the few items whose closure is mostly made of
+        them, which may be similar to others without sharing any other
+        superclass, are compared with each other directly. The superclasses
+        with less IC than `min_ic` are also left out of the index, and pairs
+        that only share such superclasses are never reported.
+        """
+        
+        if threshold <= 0:
+            raise ValueError("The threshold must be positive")
+        
+        concepts = [to_id_strings(item) if item else None for item in items]
+        closures = [self.get(c) if c is not None else None for c in concepts]
+        
+        def get_ic(superclass, weight):
+            if ic_values is None:
+                return weight
+            if 0 <= superclass < len(ic_values):
+                return ic_values[superclass]
+            return -1
+        
+        # When an extended hierarchy is used, a superclass that is common in
+        # the regular hierarchy and in the extended one counts only once, so
+        # each hierarchy needs its own index
+        indexes = [defaultdict(list), defaultdict(list)]
+        weights = {}
+        skipped = False
+        for position, item_closures in enumerate(closures):
+            if item_closures is None:
+                continue
+            for index, closure in zip(indexes, item_closures):
+                if closure is None:
+                    continue
+                for superclass, weight in zip(closure.ids, closure.weights):
+                    # Superclasses without weight add nothing to the
+                    # intersection
+                    if weight <= 0:
+                        continue
+                    ic = get_ic(superclass, weight)
+                    if ic > 0 and (min_ic is None or ic >= min_ic):
+                        index[superclass].append(position)
+                        weights[superclass] = weight
+                    else:
+                        skipped = True
+        
+        # The positions in each list are sorted, so the first item of each
+        # pair always comes before the second
+        shared = defaultdict(float)
+        for index in indexes:
+            for superclass, positions in index.items():
+                weight = weights[superclass]
+                for start, one in enumerate(positions):
+                    for two in positions[start:]:
+                        shared[one, two] += weight
+        
+        if min_ic is None or min_ic <= 0:
+            # A pair that only shares superclasses without IC has at most the
+            # weight of those of either item in common, and at least the
+            # weight of all the superclasses of either item in its union, so
+            # only the items where the former is a large enough fraction of
+            # the latter can be in such a pair
+            uninformative = []
+            for position, item_closures in enumerate(closures):
+                if item_closures is None:
+                    continue
+                closure = item_closures[2]
+                weight = sum(w for i, w in zip(closure.ids, closure.weights)
+                             if w > 0 and get_ic(i, w) <= 0)
+                if weight > 0 and weight >= threshold * closure.total:
+                    uninformative.append(position)
+            
+            for start, one in enumerate(uninformative):
+                for two in uninformative[start:]:
+                    shared.setdefault((one, two), 0)
+        
+        # Unless some superclasses were left out, or may have been counted
+        # twice, the accumulated weights are the exact intersections
+        exact = self.hierarchy is None and not skipped
+        
+        results = []
+        for (one, two), inter in shared.items():
+            if exact:
+                union = closures[one][2].total + closures[two][2].total - inter
+            else:
+                inter, union = self.get_inter_union(concepts[one],
+                                                    concepts[two])
+            similarity = inter / union
+            if similarity >= threshold:
+                results.append((one, two, similarity))
+        
+        results.sort()
+        return results
 
 
 @plugin()
@@ -20,20 +355,38 @@ class sim_ui:
     
     Usage:
         .compare(one, two)
+        .compare_many(pairs)
+        .join(items, threshold, min_ic=None, ic="seco")
     where
         `one` and `two` are concepts or lists of concepts (mixed input is
             allowed)
+        `pairs` is a sequence of (one, two) pairs; the result is the list of
+            their comparisons, computed with a few large queries (or in
+            memory, if the superclasses of the items are cached)
+        `items` is a list of items; the result is the sorted list of
+            (index, index, similarity) triples of the pairs of items whose
+            similarity is at least `threshold`, found without comparing
+            every pair. If `min_ic` is given, the pairs of items whose common
+            superclasses all have a lower information content, according to
+            the measure `ic`, are skipped
     
     SIM_UI is a measure defined in Gentleman R (2005). Visualizing and distances
     using GO. The result is the ratio between the number of common superclasses
     and all superclasses of the concepts in `one` and the concepts in `two`
     """
     
+    symmetric = True
+    
+    
     def __init__(self, hierarchy=None, relevance=None, threshold=None):
         
         if relevance is not None:
             sql.assert_identifier(relevance)
         
+        self.hierarchy = hierarchy
+        self.closures = ClosureCache("1", None, hierarchy, relevance,
+                                     threshold)
+        
         if hierarchy is None:
             # This query will select the classes that are part of both sets of
             # superclasses
@@ -54,7 +407,7 @@ class sim_ui:
             if relevance is not None:
                 self.inter_query += (
                     "AND relevance.{} >= {}"
-                    .format(relevance, sql.conn.escape(threshold)))
+                    .format(relevance, sql.escape(threshold)))
             
             # We need to do the same thing for the union of the superclass sets
             self.union_query = (
@@ -67,7 +420,7 @@ class sim_ui:
             if relevance is not None:
                 self.union_query += (
                     " AND relevance.{} >= {}"
-                    .format(relevance, sql.conn.escape(threshold)))
+                    .format(relevance, sql.escape(threshold)))
         
         else:
             self.inter_query = (
@@ -88,12 +441,12 @@ class sim_ui:
                 "                           FROM extended_hierarchy "
                 "                           WHERE subclass IN ({{1}}) AND "
                 "                                 extension = {hierarchy}) "
-                .format(hierarchy=sql.conn.escape(hierarchy)))
+                .format(hierarchy=sql.escape(hierarchy)))
             if relevance is not None:
                 self.inter_query = (
                     "JOIN relevance ON relevance.id = s.superclass "
                     "WHERE relevance.{} >= {}"
-                    .format(relevance, sql.conn.escape(threshold)))
+                    .format(relevance, sql.escape(threshold)))
             
             self.union_query = (
                 "SELECT COUNT(DISTINCT superclass) "
@@ -106,51 +459,90 @@ class sim_ui:
                 "      WHERE extension = {} AND "
                 "            subclass IN ({{0}}) "
                 "     ) AS s"
-                .format(sql.conn.escape(hierarchy)))
+                .format(sql.escape(hierarchy)))
             if relevance is not None:
                 self.union_query = (
                     "JOIN relevance ON relevance.id = s.superclass "
                     "WHERE relevance.{} >= {}"
-                    .format(relevance, sql.conn.escape(threshold)))
+                    .format(relevance, sql.escape(threshold)))
     
     def compare(self, one, two):
         if not one or not two:
             return 0
         
-        # If only one concept is given as either argument, encapsulate it into
-        # a list
-        one = utils.to_seq(one)
-        two = utils.to_seq(two)
-        
-        # We need to convert to strings since we will build a query string from
-        # these ids
-        one = [str(i) for i in utils.seq_to_ids(one)]
-        two = [str(i) for i in utils.seq_to_ids(two)]
+        one, two = get_id_strings(one, two)
         
-        inter = self.run_inter(one, two)
-        union = self.run_union(one, two)
+        if CACHE_CLOSURES:
+            inter, union = self.closures.get_inter_union(one, two)
+        elif use_staging(self, one, two):
+            inter, union = run_staged(self, one, two)
+        else:
+            inter = self.run_inter(one, two)
+            union = self.run_union(one, two)
         
         return inter / union
     
     
-    def run_inter(self, one, two):
-        one = ','.join(one)
-        two = ','.join(two)
+    def compare_many(self, pairs):
+        if CACHE_CLOSURES:
+            return [self.compare(one, two) for one, two in pairs]
+        
+        pairs = [get_id_strings(one, two) if one and two else None
+                 for one, two in pairs]
+        
+        # The pairs with large items are not worth batching, since their
+        # queries would be too long
+        queries = []
+        for pair in pairs:
+            if pair is not None and not use_staging(self, *pair):
+                queries.append(self.get_inter_query(*pair))
+                queries.append(self.get_union_query(*pair))
+        values = iter(run_batch(queries))
         
-        query = self.inter_query.format(one, two)
+        results = []
+        for pair in pairs:
+            if pair is None:
+                results.append(0)
+            elif use_staging(self, *pair):
+                inter, union = run_staged(self, *pair)
+                results.append(inter / union)
+            else:
+                inter = next(values)
+                union = next(values)
+                results.append(inter / union)
+        return results
+    
+    
+    def join(self, items, threshold, min_ic=None, ic="seco"):
+        # All the superclasses have the same weight, so their IC comes from
+        # the given measure
+        calculator = ICCalculator(ic)
+        calculator.preload()
+        return self.closures.join(items, threshold, min_ic,
+                                  calculator.values)
+    
+    
+    def get_inter_query(self, one, two):
+        return self.inter_query.format(','.join(one), ','.join(two))
+    
+    
+    def get_union_query(self, one, two):
+        return self.union_query.format(','.join(set(one).union(two)))
+    
+    
+    def run_inter(self, one, two):
+        query = self.get_inter_query(one, two)
         logging.debug("INTER query = %s", query)
-        with sql.lock:
-            sql.cursor.execute(query)
-            return sql.cursor.fetchone()[0]
+        with sql.borrow() as cursor:
+            cursor.execute(query)
+            return cursor.fetchone()[0]
     
     
     def run_union(self, one, two):
-        all_ids = ','.join(set(one).union(two))
-        
-        query = self.union_query.format(all_ids)
-        with sql.lock:
-            sql.cursor.execute(query)
-            return sql.cursor.fetchone()[0]
+        query = self.get_union_query(one, two)
+        with sql.borrow() as cursor:
+            cursor.execute(query)
+            return cursor.fetchone()[0]
     
 
 @plugin()
@@ -169,9 +561,19 @@ class sim_gic:
     
     Usage:
         .compare(one, two)
+        .compare_many(pairs)
+        .join(items, threshold, min_ic=None)
     where
         `one` and `two` are concepts or lists of concepts (mixed input is
             allowed)
+        `pairs` is a sequence of (one, two) pairs; the result is the list of
+            their comparisons, computed with a few large queries (or in
+            memory, if the superclasses of the items are cached)
+        `items` is a list of items; the result is the sorted list of
+            (index, index, similarity) triples of the pairs of items whose
+            similarity is at least `threshold`, found without comparing
+            every pair. If `min_ic` is given, the pairs of items whose common
+            superclasses all have a lower information content are skipped
     
     SIM_GIC is a measure defined in Pesquita C, Faria D, Bastos H, Falcão A,
     Couto F (2007). Evaluating GO-based semantic similarity measures. In Proc.
@@ -181,6 +583,9 @@ class sim_gic:
     weighted according to its information content.
     """
     
+    symmetric = True
+    
+    
     def __init__(self, ic, hierarchy=None, relevance=None, threshold=None):
         sql.assert_identifier(ic)
         if relevance is not None:
@@ -193,6 +598,10 @@ class sim_gic:
             table = "extrinsic_ic"
             column = "ic"
         
+        self.hierarchy = hierarchy
+        self.closures = ClosureCache("t." + column, table, hierarchy,
+                                     relevance, threshold)
+        
         if hierarchy is None:
             # This partial query will select the classes that are part of both
             # sets of superclasses
@@ -208,7 +617,7 @@ class sim_gic:
                 "      ) ")
             if relevance is not None:
                 inner += ("AND relevance.{} >= {}"
-                          .format(relevance, sql.conn.escape(threshold)))
+                          .format(relevance, sql.escape(threshold)))
             
             # This selects the sum of their IC values
             self.inter_query = (
@@ -224,7 +633,7 @@ class sim_gic:
             inner += "WHERE subclass IN ({}) "
             if relevance is not None:
                 inner += ("AND relevance.{} >= {}"
-                          .format(relevance, sql.conn.escape(threshold)))
+                          .format(relevance, sql.escape(threshold)))
             
             self.union_query = (
                 "SELECT SUM(t.{column}) "
@@ -258,12 +667,12 @@ class sim_gic:
                 "           ) AS s "
                 "     ) AS supers ON supers.superclass = t.id"
                 .format(table=table, column=column,
-                        hierarchy=sql.conn.escape(hierarchy)))
+                        hierarchy=sql.escape(hierarchy)))
             if relevance is not None:
                 self.inter_query = (
                     "JOIN relevance ON relevance.id = supers.superclass "
                     "WHERE relevance.{} >= {}"
-                    .format(relevance, sql.conn.escape(threshold)))
+                    .format(relevance, sql.escape(threshold)))
             
             self.union_query = (
                 "SELECT SUM(t.{column}) "
@@ -280,27 +689,33 @@ class sim_gic:
                 "           ) AS s "
                 "     ) AS supers ON supers.superclass = t.id"
                 .format(table=table, column=column,
-                        hierarchy=sql.conn.escape(hierarchy)))
+                        hierarchy=sql.escape(hierarchy)))
             if relevance is not None:
                 self.union_query = (
                     "JOIN relevance ON relevance.id = supers.superclass "
                     "WHERE relevance.{} >= {}"
-                    .format(relevance, sql.conn.escape(threshold)))
+                    .format(relevance, sql.escape(threshold)))
     
     
     def compare(self, one, two):
         if not one or not two:
             return 0
         
-        # If only one concept is given as either argument, encapsulate it into
-        # a list
-        one = utils.to_seq(one)
-        two = utils.to_seq(two)
+        one, two = get_id_strings(one, two)
         
-        # We need to convert to strings since we will build a query string from
-        # these ids
-        one = [str(i) for i in utils.seq_to_ids(one)]
-        two = [str(i) for i in utils.seq_to_ids(two)]
+        if CACHE_CLOSURES:
+            inter, union = self.closures.get_inter_union(one, two)
+            if inter == 0:
+                # See the note below
+                return 0
+            return inter / union
+        
+        if use_staging(self, one, two):
+            inter, union = run_staged(self, one, two)
+            inter = inter or 0
+            if inter == 0:
+                return 0
+            return inter / union
         
         inter = self.run_inter(one, two);
         if inter == 0:
@@ -316,23 +731,67 @@ class sim_gic:
         return inter / union;
     
     
-    def run_inter(self, one, two):
-        one = ','.join(one)
-        two = ','.join(two)
+    def compare_many(self, pairs):
+        if CACHE_CLOSURES:
+            return [self.compare(one, two) for one, two in pairs]
+        
+        pairs = [get_id_strings(one, two) if one and two else None
+                 for one, two in pairs]
         
-        query = self.inter_query.format(one, two)
+        # The pairs with large items are not worth batching, since their
+        # queries would be too long
+        queries = []
+        for pair in pairs:
+            if pair is not None and not use_staging(self, *pair):
+                queries.append(self.get_inter_query(*pair))
+                queries.append(self.get_union_query(*pair))
+        values = iter(run_batch(queries))
+        
+        results = []
+        for pair in pairs:
+            if pair is None:
+                results.append(0)
+                continue
+            
+            if use_staging(self, *pair):
+                inter, union = run_staged(self, *pair)
+            else:
+                inter, union = next(values), next(values)
+            
+            inter = inter or 0
+            union = union or 0
+            if inter == 0:
+                # See the note in `compare`
+                results.append(0)
+            else:
+                results.append(inter / union)
+        return results
+    
+    
+    def join(self, items, threshold, min_ic=None):
+        return self.closures.join(items, threshold, min_ic)
+    
+    
+    def get_inter_query(self, one, two):
+        return self.inter_query.format(','.join(one), ','.join(two))
+    
+    
+    def get_union_query(self, one, two):
+        return self.union_query.format(','.join(set(one).union(two)))
+    
+    
+    def run_inter(self, one, two):
+        query = self.get_inter_query(one, two)
         logging.debug("INTER query = %s", query)
-        with sql.lock:
-            sql.cursor.execute(query)
-            return sql.cursor.fetchone()[0] or 0
+        with sql.borrow() as cursor:
+            cursor.execute(query)
+            return cursor.fetchone()[0] or 0
     
     
     def run_union(self, one, two):
-        all_ids = ','.join(set(one).union(two))
-        
-        query = self.union_query.format(all_ids)
+        query = self.get_union_query(one, two)
         logging.debug("UNION query = %s", query)
-        with sql.lock:
-            sql.cursor.execute(query)
-            return sql.cursor.fetchone()[0] or 0
+        with sql.borrow() as cursor:
+            cursor.execute(query)
+            return cursor.fetchone()[0] or 0
     
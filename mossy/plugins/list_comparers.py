@@ -1,16 +1,60 @@
+import heapq
+import math
+
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from mossy import utils
 from mossy.parse_config import plugin
+from mossy.plugins import concept_comparers
+
+
+# When pruning, the cells that may still change the result are compared in
+# batches of this size, in decreasing order of their upper bound
+PRUNING_BATCH_SIZE = 16
+
+
+def hashable(obj):
+    # Concepts are usually strings, but some comparers accept sequences (for
+    # example, chains of properties); these are turned into tuples so that
+    # they can be used as dictionary keys
+    if isinstance(obj, (list, tuple)):
+        return tuple(hashable(i) for i in obj)
+    elif isinstance(obj, set):
+        return frozenset(hashable(i) for i in obj)
+    return obj
+
+
+def use_matrix(inner):
+    # Whether to compare the distinct concepts with a single call to the
+    # `compare_matrix` method of the inner comparer
+    return (numpy is not None and hasattr(inner, 'compare_matrix') and
+            concept_comparers.use_matrix())
+
 
 @plugin()
 class lift_concept_comparer:
     """
     Constructor:
-        lift_concept_comparer(inner, aggr)
+        lift_concept_comparer(inner, aggr, streaming=False, prune=False)
     where
         `inner` is a concept comparer (a comparer that can compare one concept
             to another)
         `aggr` is an object that contains the .aggregate method. Common values
             include the plugins `list_min`, `list_max`, `list_avg`, `list_bma`
             and `list_hna`.
+        `streaming` is a boolean to indicate whether to give the matrix to the
+            aggregator one row at a time, without ever building the whole
+            matrix. This requires an aggregator with the .init, .update_row
+            and .finalize methods, which all the plugins above have.
+        `prune` is a boolean to indicate whether to skip the comparisons that
+            cannot change the result. This only applies to the `list_max` and
+            `list_bma(best_match="max")` aggregators, with an inner comparer
+            that has an .upper_bound method, such as `resnik` and `lin`.
     
     Usage:
         .compare(one, two)
@@ -19,26 +63,43 @@ class lift_concept_comparer:
     
     Each concept in `one` is compared to each concept in `two`, producing a
     matrix of similarity values. This comparer uses a specified strategy to
-    aggregate the matrix into a single value.
+    aggregate the matrix into a single value. If NumPy is available, the
+    matrix is given to the aggregator as a NumPy array.
+    
+    Repeated concepts are compared only once. If the inner comparer has a
+    `symmetric` attribute set to True, the comparison of `a` with `b` is also
+    used for `b` with `a`. If it has a `compare_matrix` method (and NumPy is
+    available), all the comparisons are requested with a single call to it,
+    but only when the superclasses of the concepts are kept in memory (with
+    a snapshot or the ancestor cache); otherwise, the pairs are compared with
+    its `compare_many` method, if any.
+    
+    When pruning, the pairs are compared in decreasing order of their upper
+    bound, and a pair is skipped when its bound is no greater than the best
+    value already found in its row and in its column (or, with `list_max`,
+    in the whole matrix). The aggregator receives `-inf` for these pairs;
+    the result is the same as without pruning. Pruning takes precedence over
+    streaming.
+    
+    When streaming, the aggregator receives the rows in any order through
+    `state = aggr.update_row(state, row)`, where `state` starts as
+    `aggr.init(rows, cols)`, and the final value is
+    `aggr.finalize(state, one, two)`.
     
     See also: `list_min`, `list_max`, `list_avg`, `list_bma`, `list_hna`
     """
     
-    def __init__(self, inner, aggr):
+    def __init__(self, inner, aggr, streaming=False, prune=False):
         self.inner = inner
         self.aggr = aggr
+        self.streaming = streaming and hasattr(aggr, 'update_row')
+        self.prune = (prune and hasattr(inner, 'upper_bound') and
+                      (isinstance(aggr, list_max) or
+                       isinstance(aggr, list_bma) and aggr.name == "max"))
     
     
     def compare(self, one, two):
-        matrix = []
-        for first in one:
-            row = []
-            for second in two:
-                sim = self.inner.compare(first, second)
-                row.append(sim)
-            matrix.append(row)
-        
-        if not matrix or not matrix[0]:
+        if not one or not two:
             if hasattr(self.inner, 'void'):
                 # If the inner comparer defines the value that should be given
                 # to the comparison between entities one of which is void, use
@@ -47,7 +108,139 @@ class lift_concept_comparer:
             else:
                 return 0
         
+        if self.streaming and not self.prune:
+            return self.compare_streaming(one, two)
+        
+        # Compare only the distinct concepts and then broadcast the values
+        # back into the full matrix
+        firsts = {hashable(first): first for first in one}
+        seconds = {hashable(second): second for second in two}
+        
+        values = None
+        if self.prune:
+            values = self.compare_pruned(firsts, seconds)
+        if values is None:
+            values = self.compare_distinct(firsts, seconds)
+        
+        second_keys = [hashable(second) for second in two]
+        matrix = [[values[first, second] for second in second_keys]
+                  for first in map(hashable, one)]
+        if numpy is not None:
+            matrix = numpy.array(matrix, dtype=float)
+        
         return self.aggr.aggregate(matrix, one, two)
+    
+    
+    def compare_streaming(self, one, two):
+        # Only one row of the matrix exists at any given time. Each distinct
+        # concept of `one` is compared with the distinct concepts of `two`,
+        # and its row is given to the aggregator once for each time the
+        # concept appears in `one`
+        firsts = {hashable(first): first for first in one}
+        counts = Counter(map(hashable, one))
+        
+        seconds = {}
+        for second in two:
+            seconds.setdefault(hashable(second), second)
+        positions = {key: index for index, key in enumerate(seconds)}
+        columns = [positions[hashable(second)] for second in two]
+        seconds = list(seconds.values())
+        
+        state = self.aggr.init(len(one), len(two))
+        for key, first in firsts.items():
+            values = self.compare_row(first, seconds)
+            row = [values[index] for index in columns]
+            for _ in range(counts[key]):
+                state = self.aggr.update_row(state, row)
+        
+        return self.aggr.finalize(state, one, two)
+    
+    
+    def compare_row(self, first, seconds):
+        if use_matrix(self.inner):
+            return self.inner.compare_matrix([first], seconds)[0].tolist()
+        
+        pairs = [(first, second) for second in seconds]
+        return utils.compare_many(self.inner, pairs)
+    
+    
+    def compare_pruned(self, firsts, seconds):
+        # Like `compare_distinct`, but with `-inf` for the pairs that cannot
+        # be the best match of their row or column. Returns `None` if some
+        # pair has no upper bound.
+        bounds = []
+        for first, one in firsts.items():
+            for second, two in seconds.items():
+                bound = self.inner.upper_bound(one, two)
+                if bound is None:
+                    return None
+                bounds.append((bound, first, second))
+        bounds.sort(key=lambda item: item[0], reverse=True)
+        
+        only_overall = isinstance(self.aggr, list_max)
+        best = -math.inf
+        best_rows = dict.fromkeys(firsts, -math.inf)
+        best_cols = dict.fromkeys(seconds, -math.inf)
+        
+        result = {}
+        for start in range(0, len(bounds), PRUNING_BATCH_SIZE):
+            keys = []
+            for bound, first, second in bounds[start:start +
+                                                PRUNING_BATCH_SIZE]:
+                if only_overall:
+                    skip = bound <= best
+                else:
+                    skip = (bound <= best_rows[first] and
+                            bound <= best_cols[second])
+                
+                if skip:
+                    result[first, second] = -math.inf
+                else:
+                    keys.append((first, second))
+            
+            pairs = [(firsts[first], seconds[second])
+                     for first, second in keys]
+            values = utils.compare_many(self.inner, pairs)
+            for (first, second), value in zip(keys, values):
+                result[first, second] = value
+                best = max(best, value)
+                best_rows[first] = max(best_rows[first], value)
+                best_cols[second] = max(best_cols[second], value)
+        
+        return result
+    
+    
+    def compare_distinct(self, firsts, seconds):
+        # Returns a dictionary with the value of each pair of keys of the
+        # given dictionaries, which associate keys with concepts
+        if use_matrix(self.inner):
+            matrix = self.inner.compare_matrix(list(firsts.values()),
+                                               list(seconds.values()))
+            matrix = matrix.tolist()
+            return {(first, second): matrix[i][j]
+                    for i, first in enumerate(firsts)
+                    for j, second in enumerate(seconds)}
+        
+        symmetric = getattr(self.inner, 'symmetric', False)
+        keys = []
+        seen = set()
+        for first in firsts:
+            for second in seconds:
+                if symmetric and (second, first) in seen:
+                    continue
+                seen.add((first, second))
+                keys.append((first, second))
+        
+        pairs = [(firsts[first], seconds[second]) for first, second in keys]
+        result = dict(zip(keys, utils.compare_many(self.inner, pairs)))
+        
+        if symmetric:
+            for first in firsts:
+                for second in seconds:
+                    if (first, second) not in result:
+                        result[first, second] = result[second, first]
+        
+        return result
 
 
 @plugin()
@@ -61,7 +254,21 @@ class list_min:
     """
     
     def aggregate(self, matrix, one, two):
+        if numpy is not None:
+            return float(numpy.min(matrix))
         return min(value for row in matrix for value in row)
+    
+    
+    def init(self, rows, cols):
+        return math.inf
+    
+    
+    def update_row(self, state, row):
+        return min(state, min(row))
+    
+    
+    def finalize(self, state, one, two):
+        return state
 
 
 @plugin()
@@ -75,7 +282,21 @@ class list_max:
     """
     
     def aggregate(self, matrix, one, two):
+        if numpy is not None:
+            return float(numpy.max(matrix))
         return max(value for row in matrix for value in row)
+    
+    
+    def init(self, rows, cols):
+        return -math.inf
+    
+    
+    def update_row(self, state, row):
+        return max(state, max(row))
+    
+    
+    def finalize(self, state, one, two):
+        return state
 
 
 @plugin()
@@ -89,9 +310,27 @@ class list_avg:
     """
     
     def aggregate(self, matrix, one, two):
+        if numpy is not None:
+            return float(numpy.mean(matrix))
+        
         total = sum(value for row in matrix for value in row)
         count = sum(1 for row in matrix for value in row)
         return total / count
+    
+    
+    def init(self, rows, cols):
+        # The total and the count of the values
+        return 0, 0
+    
+    
+    def update_row(self, state, row):
+        total, count = state
+        return total + sum(row), count + len(row)
+    
+    
+    def finalize(self, state, one, two):
+        total, count = state
+        return total / count
 
 
 @plugin()
@@ -120,19 +359,48 @@ class list_bma:
         else:
             raise ValueError(
                 "Valid values for `best_match` are 'max' and 'min'.")
+        self.name = best_match
     
     
     def aggregate(self, matrix, one, two):
-        max_rows = [max(row) for row in matrix]
+        # The rows always use their maximum, and the best match of each
+        # column is taken between its values and 0
+        if numpy is not None:
+            matrix = numpy.asarray(matrix, dtype=float)
+            best_rows = matrix.max(axis=1)
+            if self.name == "max":
+                best_cols = numpy.maximum(matrix.max(axis=0), 0)
+            else:
+                best_cols = numpy.minimum(matrix.min(axis=0), 0)
+            num = best_rows.sum() + best_cols.sum()
+            den = len(best_rows) + len(best_cols)
+            return float(num / den)
         
-        max_cols = [0 for i in matrix[0]]
-        for row in matrix:
-            for col_no, value in enumerate(row):
-                max_cols[col_no] = self.best_match(max_cols[col_no], value)
+        best_rows = [max(row) for row in matrix]
+        best_cols = [self.best_match(0, self.best_match(col))
+                     for col in zip(*matrix)]
         
-        num = sum(max_rows) + sum(max_cols)
-        den = len(max_rows) + len(max_cols)
+        num = sum(best_rows) + sum(best_cols)
+        den = len(best_rows) + len(best_cols)
         return num / den
+    
+    
+    def init(self, rows, cols):
+        # The sum and the number of the row maxima seen so far, and the best
+        # match of each column
+        return 0, 0, [0] * cols
+    
+    
+    def update_row(self, state, row):
+        total, count, best_cols = state
+        best_cols = [self.best_match(best, value)
+                     for best, value in zip(best_cols, row)]
+        return total + max(row), count + 1, best_cols
+    
+    
+    def finalize(self, state, one, two):
+        total, count, best_cols = state
+        return (total + sum(best_cols)) / (count + len(best_cols))
 
 
 @plugin()
@@ -159,17 +427,65 @@ class list_hna:
         self.mode = mode
     
     
-    def aggregate(self, matrix, one, two):
-        flat = sorted(value for row in matrix for value in row)
-        
+    def get_count(self, size):
+        # The number of values to consider out of the `size` in the matrix,
+        # truncated to an integer. As when slicing the last `n` sorted
+        # values, a count of 0 takes all of them in the 'highest' mode (and
+        # none in the 'lowest' mode)
         if self.n < 1:
-            n = self.n * len(flat)
+            n = int(self.n * size)
         else:
-            n = min(self.n, len(flat))
+            n = int(min(self.n, size))
+        
+        if n == 0 and self.mode == "highest":
+            return size
+        return n
+    
+    
+    def aggregate(self, matrix, one, two):
+        if numpy is not None:
+            flat = numpy.asarray(matrix, dtype=float).ravel()
+            n = self.get_count(flat.size)
+            
+            # Partitioning finds the `n` values without sorting the matrix
+            if self.mode == "highest":
+                index = numpy.argpartition(flat, flat.size - n)
+                highest = flat[index[flat.size - n:]]
+            else:
+                index = numpy.argpartition(flat, max(n - 1, 0))
+                highest = flat[index[:n]]
+            return float(highest.sum()) / len(highest)
+        
+        flat = [value for row in matrix for value in row]
+        n = self.get_count(len(flat))
         
         if self.mode == "highest":
-            highest = flat[-n:]
+            highest = heapq.nlargest(n, flat)
         else:
-            highest = flat[:n]
+            highest = heapq.nsmallest(n, flat)
         
         return sum(highest) / len(highest)
+    
+    
+    def init(self, rows, cols):
+        # The state is the number of values to keep and a heap with the best
+        # values seen so far, whose first element is the worst of them. For
+        # the lowest values, the heap holds their negatives.
+        return self.get_count(rows * cols), []
+    
+    
+    def update_row(self, state, row):
+        n, heap = state
+        sign = 1 if self.mode == "highest" else -1
+        for value in row:
+            if len(heap) < n:
+                heapq.heappush(heap, sign * value)
+            elif heap and sign * value > heap[0]:
+                heapq.heapreplace(heap, sign * value)
+        return state
+    
+    
+    def finalize(self, state, one, two):
+        n, heap = state
+        sign = 1 if self.mode == "highest" else -1
+        return sign * sum(heap) / len(heap)
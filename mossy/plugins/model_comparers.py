@@ -1,6 +1,24 @@
+import atexit
+
+from concurrent.futures import ThreadPoolExecutor
+
 from mossy import utils
 from mossy.parse_config import plugin
 
+
+def get_executor(threads):
+    # Returns a pool of threads where the domains are compared, or `None` to
+    # compare them in the calling thread
+    if not threads or threads == 1:
+        return None
+    
+    # The comparers live as long as the program, so their threads are shut
+    # down when it exits
+    executor = ThreadPoolExecutor(max_workers=threads)
+    atexit.register(executor.shutdown)
+    return executor
+
+
 @plugin()
 class integrative_comparer:
     """
@@ -34,12 +52,15 @@ class integrative_comparer:
 class simple_model_comparer:
     """
     Constructor:
-        simple_model_comparer(inners, aggr)
+        simple_model_comparer(inners, aggr, threads=None)
     where
         `ìnners` is a dictionary that associates domain names with list
             comparers
         `aggr` is an object that contains the .aggregate method. Common values
             include the plugins `model_min`, `model_max` and `model_avg`.
+        `threads` is the number of domains to compare at the same time. Each
+            thread needs its own database connection, so this is only useful
+            with a connection pool (see the `--pool-size` option).
     
     Usage:
         .compare(one, two)
@@ -56,21 +77,26 @@ class simple_model_comparer:
     See also: `model_min`, `model_max`, `model_avg`
     """
     
-    def __init__(self, inners, aggr):
+    def __init__(self, inners, aggr, threads=None):
         self.inners = inners
         self.aggr = aggr
+        self.executor = get_executor(threads)
     
     
     def compare(self, one, two):
         similarities = {}
         
-        for key, inner in self.inners.items():
-            first = one.get(key, [])
-            second = two.get(key, [])
-            
-            if first and second:
-                similarities[key] = inner.compare(first, second)
-        
+        keys = [key for key in self.inners if one.get(key) and two.get(key)]
+        if self.executor is None:
+            for key in keys:
+                similarities[key] = self.inners[key].compare(one[key],
+                                                             two[key])
+        else:
+            futures = {key: self.executor.submit(self.inners[key].compare,
+                                                 one[key], two[key])
+                       for key in keys}
+            for key in keys:
+                similarities[key] = futures[key].result()
         
         if not similarities:
             return 0
@@ -83,13 +109,16 @@ class simple_model_comparer:
 class aggregative_comparer:
     """
     Constructor:
-        aggregative_comparer(inner, aggr, only=[])
+        aggregative_comparer(inner, aggr, only=[], threads=None)
     where
         `ìnner` is a comparer to compare cocnepts within each domain
         `aggr` is an object that contains the .aggregate method. Common values
             include the plugins `model_min`, `model_max` and `model_avg`.
         `only` is a list of domain names. If provided, only those domains are
             used to compare the models; otherwise, all common domains are used
+        `threads` is the number of domains to compare at the same time. Each
+            thread needs its own database connection, so this is only useful
+            with a connection pool (see the `--pool-size` option).
     
     Usage:
         .compare(one, two)
@@ -106,15 +135,14 @@ class aggregative_comparer:
     See also: `model_min`, `model_max`, `model_avg`
     """
     
-    def __init__(self, inner, aggr, only=None):
+    def __init__(self, inner, aggr, only=None, threads=None):
         self.inner = inner
         self.aggr = aggr
         self.only = only
+        self.executor = get_executor(threads)
     
     
     def compare(self, one, two):
-        similarities = {}
-        
         # Get the list of domains to consider (the intersection of them)
         domains = set(one).intersection(two)
         if self.only is not None:
@@ -123,10 +151,16 @@ class aggregative_comparer:
         if not domains:
             return 0
         
-        for domain in domains:
-            first = one[domain]
-            second = two[domain]
-            similarities[domain] = self.inner.compare(first, second)
+        # Without threads, all the domains are compared with a single call to
+        # the inner comparer
+        domains = list(domains)
+        pairs = [(one[domain], two[domain]) for domain in domains]
+        if self.executor is None:
+            values = utils.compare_many(self.inner, pairs)
+        else:
+            values = list(self.executor.map(
+                lambda pair: self.inner.compare(*pair), pairs))
+        similarities = dict(zip(domains, values))
         
         return self.aggr.aggregate(similarities, one, two)
 
@@ -44,7 +44,8 @@ class subsumption:
                 "UNION "
                 "SELECT superclass "
                 "FROM extended_hierarchy "
-                "WHERE extension = '{}' AND subclass = %s ".format(hierarchy))
+                "WHERE extension = {} AND subclass = %s "
+                .format(sql.escape(hierarchy)))
             self.two_args = True
     
     
@@ -52,13 +53,13 @@ class subsumption:
         one = utils.get_id(one)
         two = utils.seq_to_ids(two)
         
-        with sql.lock:
+        with sql.borrow() as cursor:
             if not self.two_args:
                 args = (one,)
             else:
                 args = (one, one)
-            sql.cursor.execute(self.get_super_query, args)
-            superclasses = {i[0] for i in sql.cursor}
+            cursor.execute(self.get_super_query, args)
+            superclasses = {i[0] for i in cursor}
         
         # If one of the concepts in the second argument is superclass of the
         # first argument, return 1
@@ -67,7 +68,6 @@ class subsumption:
         
         # Otherwise, compare the concept with any of the concepts of the second
         # list and return the maximum similarity value found
-        result = 0
-        for second in two:
-            result = max(result, self.inner.compare(one, second))
-        return result;
+        values = utils.compare_many(self.inner,
+                                    [(one, second) for second in two])
+        return max([0] + values)
@@ -0,0 +1,145 @@
+# This module keeps an optional in-memory copy of the parts of the OWLtoSQL
+# database that are needed to compute shared information content: the
+# class-subclass hierarchy, the information content tables and the IRIs of the
+# entities. When a snapshot is loaded, the concept comparers answer their
+# queries from it instead of sending one or more queries per comparison.
+
+from array import array
+
+from mossy import sql, utils
+
+
+current = None
+
+def load_snapshot():
+    global current
+    current = Snapshot()
+    return current
+
+
+def drop_snapshot():
+    global current
+    current = None
+
+
+class Snapshot:
+    
+    def __init__(self):
+        self.size = self.load_objects() + 1
+        self.load_hierarchy()
+        self._ic_values = {}
+    
+    
+    def load_objects(self):
+        # The IRIs go directly into the caches of the utils module, which is
+        # where `get_id` and `get_entity` look first
+        max_id = 0
+        with sql.borrow_streaming() as cursor:
+            cursor.execute("SELECT id, iri, type FROM owl_objects")
+            for entity_id, iri, entity_type in cursor:
+                utils.ENTITY_CACHE[iri, entity_type] = entity_id
+                utils.ID_CACHE[entity_id] = (iri, entity_type)
+                max_id = max(max_id, entity_id)
+        
+        if utils.NEXT_ID is None:
+            utils.NEXT_ID = max_id
+        
+        return max_id
+    
+    
+    def load_hierarchy(self):
+        # The hierarchy is stored in compressed sparse row format: the
+        # superclasses of concept `c` (sorted by id) and their distances to `c`
+        # are found in the range `offsets[c]:offsets[c + 1]` of the arrays
+        # `superclasses` and `distances`
+        self.offsets = offsets = array('l', [0]) * (self.size + 1)
+        self.superclasses = array('l')
+        self.distances = array('l')
+        
+        with sql.borrow_streaming() as cursor:
+            cursor.execute(
+                "SELECT subclass, superclass, distance "
+                "FROM hierarchy "
+                "ORDER BY subclass, superclass")
+            for subclass, superclass, distance in cursor:
+                offsets[subclass + 1] += 1
+                self.superclasses.append(superclass)
+                self.distances.append(distance)
+        
+        for index in range(1, len(offsets)):
+            offsets[index] += offsets[index - 1]
+    
+    
+    def ic_values(self, table, column):
+        """
+        Returns a dense array with the information content of each concept,
+        indexed by concept id. Concepts without a value get -1. Each column is
+        read from the database only the first time it is requested.
+        """
+        
+        key = table, column
+        if key in self._ic_values:
+            return self._ic_values[key]
+        
+        values = utils.load_dense_column(table, column, self.size)
+        self._ic_values[key] = values
+        return values
+    
+    
+    def ancestors(self, concept):
+        if not 0 <= concept < self.size:
+            return 0, 0
+        return self.offsets[concept], self.offsets[concept + 1]
+    
+    
+    def get_superclasses(self, concept):
+        start, end = self.ancestors(concept)
+        return self.superclasses[start:end]
+    
+    
+    def get_ancestors(self, concept, values):
+        """
+        Returns the superclasses of the concept that have information content,
+        as a sorted array of ids, along with an array of their IC values.
+        """
+        
+        ancestors = array('l')
+        ancestor_values = array('d')
+        start, end = self.ancestors(concept)
+        for superclass in self.superclasses[start:end]:
+            if values[superclass] != -1:
+                ancestors.append(superclass)
+                ancestor_values.append(values[superclass])
+        
+        return ancestors, ancestor_values
+    
+    
+    def get_mica(self, one, two, values):
+        """
+        Returns the common superclass of `one` and `two` with the highest
+        information content, according to `values`, or `None` if they have
+        no common superclass with information content.
+        """
+        
+        i, end_i = self.ancestors(one)
+        j, end_j = self.ancestors(two)
+        superclasses = self.superclasses
+        
+        mica = None
+        ic_mica = -1
+        
+        # Both ranges are sorted, so we can intersect them by merging
+        while i < end_i and j < end_j:
+            first = superclasses[i]
+            second = superclasses[j]
+            if first < second:
+                i += 1
+            elif first > second:
+                j += 1
+            else:
+                if values[first] > ic_mica:
+                    mica, ic_mica = first, values[first]
+                i += 1
+                j += 1
+        
+        return mica
@@ -1,7 +1,28 @@
 # This module is here to allow a global cursor object and a lock to ensure
 # thread safety. It takes care to select the correct MySQL connector, either
-# MySQLdb or PyMySQL, depending on what is installed
+# MySQLdb or PyMySQL, depending on what is installed. Alternatively, the
+# database can be a SQLite file with the same tables as an OWLtoSQL database,
+# in which case no MySQL connector is needed.
+#
+# Besides the global cursor, the module keeps a pool of connections. Code that
+# may run in several threads at once should borrow a cursor from the pool for
+# each query (with `borrow()`) instead of using the global cursor, so that
+# queries on different connections can be in flight simultaneously. The first
+# connection of the pool is the global one, and it is protected by the global
+# lock both when it is borrowed and when it is used directly.
+#
+# Queries are always written for MySQL, with the `%s` parameter style. Values
+# that must be embedded in the SQL text should go through `escape()`, which
+# quotes them according to the dialect of the current connection.
 
+import contextlib
+import decimal
+import functools
+import logging
+import os
+import queue
+import re
+import sqlite3
 import threading
 
 try:
@@ -10,29 +31,289 @@ except ImportError:
     try:
         import pymysql as _driver
     except ImportError:
+        _driver = None
+
+
+if _driver is not None:
+    MySQLError = _driver.MySQLError
+else:
+    class MySQLError(Exception):
+        pass
+
+# Catch this to handle errors from whichever database is in use
+DatabaseError = (MySQLError, sqlite3.Error)
+
+
+# The tables of an OWLtoSQL database and the indexes that the plugins rely on
+# when the database is a SQLite file
+TABLES = ("owl_objects", "hierarchy", "extended_hierarchy", "intrinsic_ic",
+          "extrinsic_ic", "disjoints", "existential_relations", "relevance")
+
+SQLITE_INDEXES = {
+    "owl_objects": [("id",), ("iri", "type")],
+    "hierarchy": [("subclass", "superclass"), ("superclass", "subclass")],
+    "extended_hierarchy": [("extension", "subclass"),
+                           ("extension", "superclass")],
+    "intrinsic_ic": [("id",)],
+    "extrinsic_ic": [("id",)],
+    "disjoints": [("id1", "id2")],
+    "existential_relations": [("start", "distance")],
+    "relevance": [("id",)],
+}
+
+
+class PooledConnection:
+    
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.lock = lock
+    
+    
+    def close(self):
+        self.cursor.close()
+        self.conn.close()
+
+
+# A string literal or quoted identifier, or a `%s` placeholder outside of them
+PLACEHOLDER_PATTERN = re.compile(
+    r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|%s""")
+
+@functools.lru_cache(maxsize=1024)
+def to_qmark(query):
+    # Translates the `%s` placeholders of a query into `?`, leaving alone any
+    # `%s` inside string literals
+    return PLACEHOLDER_PATTERN.sub(
+        lambda match: "?" if match.group() == "%s" else match.group(), query)
+
+
+class SQLiteCursor:
+    """
+    Wraps a sqlite3 cursor so that it accepts the queries written for MySQL,
+    translating the `%s` placeholders into `?`.
+    """
+    
+    def __init__(self, cursor):
+        self._cursor = cursor
+    
+    
+    def execute(self, query, args=()):
+        self._cursor.execute(to_qmark(query), args)
+        return self
+    
+    
+    def executemany(self, query, seq_of_args):
+        self._cursor.executemany(to_qmark(query), seq_of_args)
+        return self
+    
+    
+    def __iter__(self):
+        return iter(self._cursor)
+    
+    
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class SQLiteConnection:
+    
+    def __init__(self, filename):
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+    
+    
+    def cursor(self):
+        return SQLiteCursor(self._conn.cursor())
+    
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def set_connection(hostname, database, username, password, pool_size=1):
+    if _driver is None:
         raise ImportError("Unable to import either 'MySQLdb' or 'pymysql'")
+    
+    def connect():
+        return _driver.connect(host=hostname, db=database,
+                               user=username, passwd=password)
+    
+    open_pool("mysql", connect, pool_size)
 
 
-MySQLError = _driver.MySQLError
+def set_sqlite_connection(filename, pool_size=1, create_indexes=True):
+    # Otherwise SQLite would create an empty database, and every comparison
+    # would silently run against no data
+    if not os.path.isfile(filename):
+        raise sqlite3.OperationalError(
+            "The SQLite database {!r} does not exist".format(filename))
+    
+    def connect():
+        return SQLiteConnection(filename)
+    
+    open_pool("sqlite", connect, pool_size)
+    
+    if create_indexes:
+        create_sqlite_indexes()
 
 
-def set_connection(hostname, database, username, password):
-    global conn, cursor, lock
+def open_pool(new_dialect, connect, pool_size):
+    global conn, cursor, lock, pool, dialect, _free
+    
+    if pool_size < 1:
+        raise ValueError("The pool must have at least one connection")
     
-    conn = _driver.connect(host=hostname, db=database,
-                           user=username, passwd=password)
-    cursor = conn.cursor()
+    dialect = new_dialect
     lock = threading.Lock()
+    pool = []
+    _free = queue.Queue()
+    for index in range(pool_size):
+        pooled = PooledConnection(connect(),
+                                  lock if index == 0 else threading.Lock())
+        pool.append(pooled)
+        _free.put(pooled)
+    
+    conn = pool[0].conn
+    cursor = pool[0].cursor
 
 
 def close_connection():
-    global conn, cursor, lock
-    cursor.close()
-    conn.close()
+    global conn, cursor, lock, pool, dialect, _free
+    for pooled in pool:
+        pooled.close()
     
     del conn
     del cursor
     del lock
+    del pool
+    del dialect
+    del _free
+
+
+@contextlib.contextmanager
+def borrow():
+    """
+    Borrows a cursor from the connection pool for the duration of the `with`
+    block, waiting until a connection is available:
+        
+        with sql.borrow() as cursor:
+            cursor.execute(query, args)
+            row = cursor.fetchone()
+    
+    With a single connection this is equivalent to using the global cursor
+    while holding the global lock.
+    """
+    
+    pooled = _free.get()
+    try:
+        with pooled.lock:
+            yield pooled.cursor
+    finally:
+        _free.put(pooled)
+
+
+@contextlib.contextmanager
+def borrow_streaming():
+    """
+    Like `borrow()`, but the cursor fetches the rows from the server while
+    they are iterated, instead of reading the whole result into memory first.
+    Use it for queries that read entire tables. The rows must be consumed
+    before the end of the `with` block.
+    """
+    
+    pooled = _free.get()
+    try:
+        with pooled.lock:
+            if dialect == "mysql":
+                cursor = pooled.conn.cursor(_driver.cursors.SSCursor)
+                try:
+                    yield cursor
+                finally:
+                    cursor.close()
+            else:
+                # SQLite cursors already fetch rows one at a time
+                yield pooled.cursor
+    finally:
+        _free.put(pooled)
+
+
+def escape(value):
+    """
+    Returns the SQL literal that represents `value` in the dialect of the
+    current connection.
+    """
+    
+    if dialect == "mysql":
+        return conn.escape(value)
+    
+    if value is None:
+        return "NULL"
+    elif isinstance(value, bool):
+        return str(int(value))
+    elif isinstance(value, (int, float)):
+        return repr(value)
+    else:
+        return "'{}'".format(str(value).replace("'", "''"))
+
+
+def create_sqlite_indexes():
+    with borrow() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        existing = {row[0] for row in cursor}
+        
+        try:
+            for table, indexes in SQLITE_INDEXES.items():
+                if table not in existing:
+                    continue
+                for columns in indexes:
+                    cursor.execute(
+                        "CREATE INDEX IF NOT EXISTS {} ON {} ({})"
+                        .format("_".join(("idx", table) + columns),
+                                table, ", ".join(columns)))
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            # Most likely a read-only copy of the database; queries still
+            # work, they are only slower
+            logging.warning("Unable to create the SQLite indexes: %s", e)
+
+
+def export_to_sqlite(filename, tables=TABLES):
+    """
+    Copies the given tables of the current (MySQL) connection into a new
+    SQLite file, which can later be used with `set_sqlite_connection`.
+    """
+    
+    def convert(value):
+        # SQLite cannot store the decimals that MySQL returns for some columns
+        if isinstance(value, decimal.Decimal):
+            return float(value)
+        return value
+    
+    target = sqlite3.connect(filename)
+    try:
+        with borrow() as cursor:
+            for table in tables:
+                assert_identifier(table)
+                try:
+                    cursor.execute("SELECT * FROM {}".format(table))
+                except DatabaseError as e:
+                    logging.warning("Skipping table %s: %s", table, e)
+                    continue
+                
+                columns = [description[0]
+                           for description in cursor.description]
+                
+                target.execute("DROP TABLE IF EXISTS {}".format(table))
+                target.execute("CREATE TABLE {} ({})"
+                               .format(table, ", ".join(columns)))
+                rows = (tuple(convert(value) for value in row)
+                        for row in cursor)
+                target.executemany(
+                    "INSERT INTO {} VALUES ({})"
+                    .format(table, ", ".join("?" for _ in columns)),
+                    rows)
+                target.commit()
+    finally:
+        target.close()
 
 
 VALID_START_CHARS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_'
@@ -1,27 +1,48 @@
 #!/usr/bin/env python3
 
-from mossy import sql
+import threading
+
+from array import array
+from collections import OrderedDict
+
+from mossy import iri_dictionary, sql
 
 
 ENTITY_CACHE = {}
 ID_CACHE = {}
 
 def get_id(iri, entity_type="Class"):
+    if isinstance(iri, int):
+        # This is already an id, for example from a compiled item
+        return iri
+    
     if (iri, entity_type) in ENTITY_CACHE:
         return ENTITY_CACHE[iri, entity_type]
     
-    with sql.lock:
-        sql.cursor.execute(
-            "SELECT id "
-            "FROM owl_objects "
-            "WHERE iri = %s AND type = %s "
-            "LIMIT 1", (iri, entity_type))
-        row = sql.cursor.fetchone()
+    if iri_dictionary.current is not None:
+        # The dictionary contains every entity of the database
+        result = iri_dictionary.current.get_id(iri, entity_type)
     
-    if row is None:
-        result = get_next_id()
     else:
-        result = row[0]
+        with sql.borrow() as cursor:
+            cursor.execute(
+                "SELECT id "
+                "FROM owl_objects "
+                "WHERE iri = %s AND type = %s "
+                "LIMIT 1", (iri, entity_type))
+            row = cursor.fetchone()
+        result = None if row is None else row[0]
+    
+    if result is None:
+        # The entity is not in the database. Several threads may be looking
+        # for it at the same time, but only one of them can give it an id.
+        with NEXT_ID_LOCK:
+            if (iri, entity_type) in ENTITY_CACHE:
+                return ENTITY_CACHE[iri, entity_type]
+            result = get_next_id()
+            ENTITY_CACHE[iri, entity_type] = result
+            ID_CACHE[result] = (iri, entity_type)
+        return result
     
     ENTITY_CACHE[iri, entity_type] = result
     ID_CACHE[result] = (iri, entity_type)
@@ -32,13 +53,17 @@ def get_entity(entity_id):
     if entity_id in ID_CACHE:
         return ID_CACHE[entity_id]
     
-    with sql.lock:
-        sql.cursor.execute(
-            "SELECT iri, type "
-            "FROM owl_objects "
-            "WHERE id = %s "
-            "LIMIT 1", (entity_id,))
-        row = sql.cursor.fetchone()
+    if iri_dictionary.current is not None:
+        row = iri_dictionary.current.get_entity(entity_id)
+    
+    else:
+        with sql.borrow() as cursor:
+            cursor.execute(
+                "SELECT iri, type "
+                "FROM owl_objects "
+                "WHERE id = %s "
+                "LIMIT 1", (entity_id,))
+            row = cursor.fetchone()
     
     if row is None:
         return None
@@ -49,25 +74,170 @@ def get_entity(entity_id):
     
 
 
+def prefetch_ids(iris, batch_size=1000):
+    """
+    Resolves all the given IRIs with a few large queries and stores the
+    results in the caches used by `get_id` and `get_entity`, so that later
+    calls do not need to query the database. IRIs of any entity type are
+    resolved. IRIs that are not in the database at all are given new ids as
+    classes, just like `get_id` would do.
+    """
+    
+    if iri_dictionary.current is not None:
+        # The IRIs will be resolved from the dictionary, without querying the
+        # database
+        return
+    
+    todo = []
+    seen = set()
+    for iri in iris:
+        if iri in seen:
+            continue
+        seen.add(iri)
+        if ((iri, "Class") not in ENTITY_CACHE and
+                (iri, "ObjectProperty") not in ENTITY_CACHE):
+            todo.append(iri)
+    
+    found = set()
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        with sql.borrow() as cursor:
+            cursor.execute(
+                "SELECT id, iri, type "
+                "FROM owl_objects "
+                "WHERE iri IN ({})".format(', '.join(['%s'] * len(batch))),
+                batch)
+            for entity_id, iri, entity_type in cursor:
+                ENTITY_CACHE[iri, entity_type] = entity_id
+                ID_CACHE[entity_id] = (iri, entity_type)
+                found.add(iri)
+    
+    # Otherwise each unknown IRI would still cost a query when it is compared
+    with NEXT_ID_LOCK:
+        for iri in todo:
+            if iri not in found and (iri, "Class") not in ENTITY_CACHE:
+                entity_id = get_next_id()
+                ENTITY_CACHE[iri, "Class"] = entity_id
+                ID_CACHE[entity_id] = (iri, "Class")
+
+
+def load_dense_column(table, column, size=None):
+    """
+    Reads a whole column of a table with an `id` column into a dense array of
+    floats indexed by id, with -1 for the ids that have no value. By default,
+    the array is large enough for the greatest id in the table.
+    """
+    
+    if size is None:
+        with sql.borrow() as cursor:
+            cursor.execute("SELECT MAX(id) FROM {}".format(table))
+            size = (cursor.fetchone()[0] or 0) + 1
+    
+    values = array('d', [-1]) * size
+    with sql.borrow_streaming() as cursor:
+        cursor.execute("SELECT id, {} FROM {}".format(column, table))
+        for key, value in cursor:
+            if value is not None and 0 <= key < size:
+                values[key] = value
+    
+    return values
+
+
+def iter_strings(obj):
+    # Finds all the strings inside an item, in any of its sequences or in the
+    # values of its dictionaries. This includes the concepts of the item, but
+    # also, for example, the properties of chains.
+    if isinstance(obj, str):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from iter_strings(value)
+    elif isinstance(obj, (tuple, list, set, frozenset)):
+        for value in obj:
+            yield from iter_strings(value)
+
+
 def seq_to_ids(seq, entity_type="Class"):
     t = type(seq)
     return t(get_id(iri, entity_type) for iri in seq)
 
 
 NEXT_ID = None
+NEXT_ID_LOCK = threading.Lock()
 def get_next_id():
     global NEXT_ID
-    if NEXT_ID is None:
-        with sql.lock:
-            sql.cursor.execute("SELECT MAX(id) FROM owl_objects")
-            NEXT_ID = sql.cursor.fetchone()[0] + 1
+    if NEXT_ID is None and iri_dictionary.current is not None:
+        NEXT_ID = iri_dictionary.current.max_id + 1
+    elif NEXT_ID is None:
+        with sql.borrow() as cursor:
+            cursor.execute("SELECT MAX(id) FROM owl_objects")
+            NEXT_ID = cursor.fetchone()[0] + 1
     else:
         NEXT_ID += 1
     
     return NEXT_ID
 
 
+def compare_many(comparer, pairs):
+    """
+    Compares each (one, two) pair with the given comparer and returns the list
+    of results. Comparers that can compare many pairs more efficiently than
+    one at a time define a `.compare_many(pairs)` method, which is used when
+    available; otherwise, `.compare` is called for each pair.
+    """
+    
+    if hasattr(comparer, "compare_many"):
+        return comparer.compare_many(pairs)
+    return [comparer.compare(one, two) for one, two in pairs]
+
+
+def compile_item(item):
+    """
+    Returns a copy of the item where the IRIs are replaced by their ids, so
+    that the comparers do not map them again in every comparison:
+      - a concept becomes its id;
+      - a sequence of concepts becomes a sorted tuple of ids;
+      - a sequence with chains (a sequence of properties followed by a
+        concept) becomes a tuple where each chain is a tuple of ids;
+      - a model becomes a `CompiledModel` with each of its domains compiled.
+    """
+    
+    if isinstance(item, str):
+        return get_id(item)
+    elif isinstance(item, dict):
+        return CompiledModel((key, compile_item(value))
+                             for key, value in item.items())
+    elif isinstance(item, (tuple, list, set)):
+        if all(isinstance(i, str) for i in item):
+            return tuple(sorted(get_id(i) for i in item))
+        return tuple(compile_chain(i) for i in item)
+    return item
+
+
+def compile_chain(chain):
+    if isinstance(chain, str):
+        return get_id(chain)
+    
+    properties = tuple(get_id(i, "ObjectProperty") for i in chain[:-1])
+    return properties + (get_id(chain[-1]),)
+
+
+class CompiledModel(dict):
+    """
+    A model whose concepts have been replaced by their ids with
+    `compile_item`. The concepts of all its domains together are computed
+    only once, the first time `model_to_seq` is called with it.
+    """
+    
+    concepts = None
+
+
 def model_to_seq(model):
+    if isinstance(model, CompiledModel):
+        if model.concepts is None:
+            model.concepts = tuple(sorted(set(model_to_seq(dict(model)))))
+        return model.concepts
+    
     return {concept for annotations in model.values()
                     for concept in annotations}
 
@@ -78,3 +248,48 @@ def to_seq(obj):
     else:
         return [obj]
 
+
+class LRUCache:
+    """
+    A cache that keeps at most `maxsize` entries, discarding the least
+    recently used entry when it is full. It counts the lookups that find an
+    entry (`hits`) and those that do not (`misses`), and can be shared by
+    several threads.
+    """
+    
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+    
+    
+    def __len__(self):
+        return len(self._data)
+    
+    
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            
+            self.misses += 1
+            return default
+    
+    
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+    
+    
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
@@ -1,7 +1,15 @@
 
+import random
+
+import pytest
+
 import mossy.plugins.concept_comparers as plugin
+import mossy.plugins.ferreira as ferreira_plugin
+import mossy.plugins.gic_ui as gic_plugin
+import mossy.plugins.list_comparers as list_plugin
+import mossy.plugins.model_comparers as model_plugin
 
-from mossy import sql, utils
+from mossy import snapshot, sql, utils
 
 sql.set_connection("localhost", "owltosql", "owltosql", "owltosql")
 
@@ -153,6 +161,66 @@ class TestICFunctions:
                 assert abs(ic - expected) < EPSILON
     
     
+    def test_preloaded_ic_values(self):
+        plugin.PRELOAD_IC = True
+        try:
+            for index, ic_name in enumerate(IC_NAMES):
+                ic_calculator = plugin.ICCalculator(ic_name)
+                for iri, values in IC_TESTS.items():
+                    concept_id = utils.get_id(iri)
+                    ic = ic_calculator.get(concept_id)
+                    assert abs(ic - values[index]) < EPSILON
+                assert ic_calculator.values is not None
+        finally:
+            plugin.PRELOAD_IC = False
+            for ic_name in IC_NAMES:
+                plugin.ICCalculator(ic_name).values = None
+    
+    
+    def test_max_parent_ic(self):
+        for ic_name in IC_NAMES:
+            ic_calculator = plugin.ICCalculator(ic_name)
+            shared_ic_calculator = plugin.SharedICCalculator(ic_name)
+            for iri in IC_TESTS:
+                concept_id = utils.get_id(iri)
+                with sql.borrow() as cursor:
+                    cursor.execute(shared_ic_calculator.z_query, (concept_id,))
+                    expected = cursor.fetchone()[0] or 0
+                result = ic_calculator.get_max_parent(concept_id)
+                assert abs(result - expected) < EPSILON
+    
+    
+    def test_stored_parent_ic(self):
+        table = "test_parent_ic"
+        ic_calculator = plugin.ICCalculator("seco")
+        measure = ic_calculator.get_measure()
+        
+        # A table with a stale fingerprint is filled again
+        ic_calculator.store_parents(table)
+        with sql.borrow() as cursor:
+            cursor.execute("UPDATE {}_fingerprints SET fingerprint = 'old' "
+                           "WHERE measure = %s".format(table), (measure,))
+            cursor.execute("UPDATE {} SET ic = -5 WHERE measure = %s"
+                           .format(table), (measure,))
+            cursor.connection.commit()
+        
+        try:
+            ic_calculator.store_parents(table)
+            with sql.borrow() as cursor:
+                cursor.execute("SELECT id, ic FROM {} WHERE measure = %s"
+                               .format(table), (measure,))
+                stored = dict(cursor.fetchall())
+            for iri in IC_TESTS:
+                concept_id = utils.get_id(iri)
+                expected = ic_calculator.get_max_parent(concept_id)
+                assert abs(stored.get(concept_id, 0) - expected) < EPSILON
+        finally:
+            with sql.borrow() as cursor:
+                cursor.execute("DROP TABLE {}".format(table))
+                cursor.execute("DROP TABLE {}_fingerprints".format(table))
+                cursor.connection.commit()
+    
+    
     def test_disjoint_factor(self):
         df = plugin.DisjointFactor()
         for one, two, result in DISJOINT_FACTOR_RESULTS:
@@ -161,6 +229,19 @@ class TestICFunctions:
             assert abs(df.get(one_id, two_id) - result) < EPSILON
     
     
+    def test_indexed_disjoint_factor(self):
+        df = plugin.DisjointFactor()
+        plugin.INDEX_DISJOINTS = True
+        try:
+            for one, two, result in DISJOINT_FACTOR_RESULTS:
+                one_id = utils.get_id(one)
+                two_id = utils.get_id(two)
+                assert abs(df.get(one_id, two_id) - result) < EPSILON
+                assert abs(df.get(two_id, one_id) - result) < EPSILON
+        finally:
+            plugin.INDEX_DISJOINTS = False
+    
+    
     def test_shared_ic(self):
         df = plugin.DisjointFactor()
         for ic in IC_NAMES:
@@ -193,3 +274,643 @@ class TestICFunctions:
                 
                 assert abs(result - expected) < EPSILON
 
+
+    def test_combined_queries(self):
+        concepts = [utils.get_id(iri) for iri in IC_TESTS]
+        pairs = [(one, two) for one in concepts for two in concepts]
+        for ic in IC_NAMES:
+            ic_calculator = plugin.ICCalculator(ic)
+            for use_disjoints in (False, True):
+                shared_ic_calculator = \
+                    plugin.SharedICCalculator(ic, use_disjoints=use_disjoints)
+                results = shared_ic_calculator.get_combined(pairs, 100)
+                for (one, two), result in zip(pairs, results):
+                    expected = (ic_calculator.get(one),
+                                ic_calculator.get(two),
+                                shared_ic_calculator.get(one, two))
+                    for value, expected_value in zip(result, expected):
+                        assert abs(value - expected_value) < EPSILON
+    
+    
+    def test_combined_queries_with_flags(self):
+        # The disjointness values are queried or taken from memory, depending
+        # on the flags, with the same results
+        concepts = [utils.get_id(iri) for iri in IC_TESTS]
+        pairs = [(one, two) for one in concepts for two in concepts]
+        shared_ic_calculator = plugin.SharedICCalculator("seco", None, True)
+        expected = [shared_ic_calculator.get(one, two) for one, two in pairs]
+        
+        try:
+            for index_disjoints in (False, True):
+                for preload_parent_ic in (False, True):
+                    plugin.INDEX_DISJOINTS = index_disjoints
+                    plugin.PRELOAD_PARENT_IC = preload_parent_ic
+                    results = shared_ic_calculator.get_combined(pairs)
+                    for (_, _, result), value in zip(results, expected):
+                        assert abs(result - value) < EPSILON
+        finally:
+            plugin.INDEX_DISJOINTS = False
+            plugin.PRELOAD_PARENT_IC = False
+
+
+class TestSnapshot:
+    
+    def test_snapshot_results(self):
+        pairs = [(one, two) for one in IC_TESTS for two in IC_TESTS]
+        comparers = []
+        for ic in IC_NAMES:
+            for use_disjoints in (False, True):
+                comparers.append(plugin.resnik(ic, None, use_disjoints))
+                comparers.append(plugin.lin(ic, None, use_disjoints))
+                comparers.append(plugin.jiang(ic, None, use_disjoints))
+        
+        expected = [[comparer.compare(one, two) for one, two in pairs]
+                    for comparer in comparers]
+        
+        snapshot.load_snapshot()
+        try:
+            for comparer, values in zip(comparers, expected):
+                for (one, two), value in zip(pairs, values):
+                    result = comparer.compare(one, two)
+                    assert abs(result - value) < EPSILON
+        finally:
+            snapshot.drop_snapshot()
+
+
+class TestAncestorCache:
+    
+    def test_cached_results(self):
+        pairs = [(one, two) for one in IC_TESTS for two in IC_TESTS]
+        comparers = []
+        for ic in IC_NAMES:
+            for use_disjoints in (False, True):
+                comparers.append(plugin.resnik(ic, None, use_disjoints))
+                comparers.append(plugin.lin(ic, None, use_disjoints))
+            comparers.append(plugin.resnik(ic, "superparts"))
+        
+        expected = [[comparer.compare(one, two) for one, two in pairs]
+                    for comparer in comparers]
+        
+        plugin.CACHE_ANCESTORS = True
+        try:
+            for comparer, values in zip(comparers, expected):
+                for (one, two), value in zip(pairs, values):
+                    result = comparer.compare(one, two)
+                    assert abs(result - value) < EPSILON
+        finally:
+            plugin.CACHE_ANCESTORS = False
+
+
+class TestMatrix:
+    
+    def test_compare_matrix(self):
+        pytest.importorskip("numpy")
+        
+        concepts = sorted(IC_TESTS)
+        for ic in IC_NAMES:
+            for use_disjoints in (False, True):
+                for comparer_class in (plugin.resnik, plugin.lin, plugin.jiang):
+                    comparer = comparer_class(ic, None, use_disjoints)
+                    matrix = comparer.compare_matrix(concepts, concepts[::2])
+                    
+                    assert matrix.shape == (len(concepts), len(concepts[::2]))
+                    for i, one in enumerate(concepts):
+                        for j, two in enumerate(concepts[::2]):
+                            expected = comparer.compare(one, two)
+                            assert abs(matrix[i, j] - expected) < EPSILON
+    
+    
+    def test_matrix_blocks(self):
+        pytest.importorskip("numpy")
+        
+        concepts = sorted(IC_TESTS)
+        for ic in IC_NAMES:
+            for comparer_class in (plugin.resnik, plugin.lin, plugin.jiang):
+                comparer = comparer_class(ic)
+                expected = comparer.compare_matrix(concepts, concepts[::2])
+                try:
+                    plugin.MATRIX_BLOCK_ROWS = 3
+                    matrix = comparer.compare_matrix(concepts, concepts[::2])
+                finally:
+                    plugin.MATRIX_BLOCK_ROWS = 1024
+                
+                assert (matrix == expected).all()
+
+
+class TestCompareMany:
+    
+    def test_compare_many(self):
+        concepts = sorted(IC_TESTS)
+        pairs = [(one, two) for one in concepts for two in concepts[::3]]
+        for ic in IC_NAMES:
+            for use_disjoints in (False, True):
+                for comparer_class in (plugin.resnik, plugin.lin, plugin.jiang):
+                    comparer = comparer_class(ic, None, use_disjoints)
+                    results = utils.compare_many(comparer, pairs)
+                    
+                    assert len(results) == len(pairs)
+                    for (one, two), result in zip(pairs, results):
+                        expected = comparer.compare(one, two)
+                        assert abs(result - expected) < EPSILON
+    
+    
+    def test_lift_repeated_concepts(self):
+        concepts = sorted(IC_TESTS)
+        one = concepts[:5] + concepts[2:4]
+        two = concepts[3:7] + concepts[:2] + concepts[3:4]
+        
+        inner = plugin.lin("seco")
+        matrix = [[inner.compare(first, second) for second in two]
+                  for first in one]
+        
+        for aggr in (list_plugin.list_avg(), list_plugin.list_bma()):
+            lifted = list_plugin.lift_concept_comparer(inner, aggr)
+            expected = aggr.aggregate(matrix, one, two)
+            assert abs(lifted.compare(one, two) - expected) < EPSILON
+    
+    
+    def test_lift_streaming(self):
+        concepts = sorted(IC_TESTS)
+        one = concepts[:8] + concepts[:2]
+        two = concepts[4:12]
+        
+        inner = plugin.lin("zhou")
+        for aggr in (list_plugin.list_min(), list_plugin.list_max(),
+                     list_plugin.list_avg(), list_plugin.list_bma(),
+                     list_plugin.list_hna(5)):
+            lifted = list_plugin.lift_concept_comparer(inner, aggr)
+            streamed = list_plugin.lift_concept_comparer(inner, aggr, True)
+            expected = lifted.compare(one, two)
+            assert abs(streamed.compare(one, two) - expected) < EPSILON
+    
+    
+    def test_lift_pruning(self):
+        concepts = sorted(IC_TESTS)
+        one = concepts[::2]
+        two = concepts[1::3]
+        
+        for inner in (plugin.resnik("seco"), plugin.lin("zhou", None, True)):
+            for aggr in (list_plugin.list_max(), list_plugin.list_bma()):
+                lifted = list_plugin.lift_concept_comparer(inner, aggr)
+                pruned = list_plugin.lift_concept_comparer(
+                    inner, aggr, prune=True)
+                expected = lifted.compare(one, two)
+                assert abs(pruned.compare(one, two) - expected) < EPSILON
+    
+    
+    def test_lift_matrix(self):
+        pytest.importorskip("numpy")
+        
+        class Inner:
+            def __init__(self):
+                self.inner = plugin.lin("seco")
+                self.matrices = 0
+            
+            def compare(self, one, two):
+                return self.inner.compare(one, two)
+            
+            def compare_many(self, pairs):
+                return self.inner.compare_many(pairs)
+            
+            def compare_matrix(self, ones, twos):
+                self.matrices += 1
+                return self.inner.compare_matrix(ones, twos)
+        
+        concepts = sorted(IC_TESTS)
+        one = concepts[:6]
+        two = concepts[3:9]
+        
+        # The matrix is only used when the superclasses are in memory
+        inner = Inner()
+        lifted = list_plugin.lift_concept_comparer(inner,
+                                                   list_plugin.list_bma())
+        expected = lifted.compare(one, two)
+        assert inner.matrices == 0
+        
+        try:
+            plugin.CACHE_ANCESTORS = True
+            assert abs(lifted.compare(one, two) - expected) < EPSILON
+            assert inner.matrices == 1
+        finally:
+            plugin.CACHE_ANCESTORS = False
+
+
+# The original pure Python aggregators, which the current ones must match
+def original_bma(matrix, best_match):
+    max_rows = [max(row) for row in matrix]
+    max_cols = [0 for i in matrix[0]]
+    for row in matrix:
+        for col_no, value in enumerate(row):
+            max_cols[col_no] = best_match(max_cols[col_no], value)
+    return (sum(max_rows) + sum(max_cols)) / (len(max_rows) + len(max_cols))
+
+
+def original_hna(matrix, n, mode):
+    flat = sorted(value for row in matrix for value in row)
+    if n < 1:
+        n = n * len(flat)
+    else:
+        n = min(n, len(flat))
+    # The original sliced with `n` as it was, which only works when it is an
+    # integer; this truncates it
+    n = int(n)
+    highest = flat[-n:] if mode == "highest" else flat[:n]
+    return sum(highest) / len(highest)
+
+
+class TestAggregators:
+    
+    def get_matrices(self):
+        generator = random.Random(1)
+        for rows, cols in ((1, 1), (1, 7), (6, 1), (4, 5), (9, 13)):
+            for low in (0, -1):
+                yield [[generator.uniform(low, 1) for _ in range(cols)]
+                       for _ in range(rows)]
+    
+    
+    def get_aggregators(self):
+        yield list_plugin.list_min(), lambda matrix: min(map(min, matrix))
+        yield list_plugin.list_max(), lambda matrix: max(map(max, matrix))
+        yield list_plugin.list_avg(), lambda matrix: (
+            sum(map(sum, matrix)) / sum(map(len, matrix)))
+        for best_match in (max, min):
+            yield (list_plugin.list_bma(best_match.__name__),
+                   lambda matrix, f=best_match: original_bma(matrix, f))
+        for n in (1, 3, 10, 2.5, 0.5, 0.3, 0.05):
+            for mode in ("highest", "lowest"):
+                yield (list_plugin.list_hna(n, mode),
+                       lambda matrix, n=n, mode=mode: original_hna(
+                           matrix, n, mode))
+    
+    
+    def get_paths(self, aggr):
+        # Returns functions that aggregate a matrix with NumPy (if it is
+        # available), without NumPy and streaming the rows
+        def with_numpy(matrix):
+            return aggr.aggregate(list_plugin.numpy.array(matrix), None, None)
+        
+        def without_numpy(matrix):
+            numpy = list_plugin.numpy
+            try:
+                list_plugin.numpy = None
+                return aggr.aggregate(matrix, None, None)
+            finally:
+                list_plugin.numpy = numpy
+        
+        def streaming(matrix):
+            state = aggr.init(len(matrix), len(matrix[0]))
+            for row in matrix:
+                state = aggr.update_row(state, row)
+            return aggr.finalize(state, None, None)
+        
+        if list_plugin.numpy is None:
+            return without_numpy, streaming
+        return with_numpy, without_numpy, streaming
+    
+    
+    def test_original_values(self):
+        for matrix in self.get_matrices():
+            for aggr, original in self.get_aggregators():
+                try:
+                    expected = original(matrix)
+                except ZeroDivisionError:
+                    # A fraction that takes no values in the 'lowest' mode
+                    for path in self.get_paths(aggr):
+                        with pytest.raises(ZeroDivisionError):
+                            path(matrix)
+                    continue
+                
+                for path in self.get_paths(aggr):
+                    assert abs(path(matrix) - expected) < EPSILON
+    
+    
+    def test_hna_zero(self):
+        for matrix in self.get_matrices():
+            aggr = list_plugin.list_hna(0)
+            expected = original_hna(matrix, 0, "highest")
+            for path in self.get_paths(aggr):
+                assert abs(path(matrix) - expected) < EPSILON
+            
+            # No values at all are taken in the 'lowest' mode
+            aggr = list_plugin.list_hna(0, "lowest")
+            for path in self.get_paths(aggr):
+                with pytest.raises(ZeroDivisionError):
+                    path(matrix)
+
+
+class TestPairCache:
+    
+    def test_pair_cache(self):
+        calculator = plugin.SharedICCalculator("seco", use_disjoints=True)
+        pairs = [(utils.get_id(one), utils.get_id(two))
+                 for one, two, mica, z in SHARED_IC_RESULTS]
+        expected = [calculator.get(one, two) for one, two in pairs]
+        
+        cache = plugin.set_pair_cache(1)
+        try:
+            # The second pass and the reversed pairs are all hits
+            for _ in range(2):
+                for (one, two), value in zip(pairs, expected):
+                    assert calculator.get(one, two) == value
+                    assert calculator.get(two, one) == value
+            
+            assert cache.misses == len(pairs)
+            assert cache.hits == 3 * len(pairs)
+        finally:
+            plugin.set_pair_cache(None)
+    
+    
+    def test_comparers(self):
+        # Concepts with IC, so that every comparison needs the shared IC
+        concepts = [concept for concept in sorted(IC_TESTS)
+                    if IC_TESTS[concept][0] > 0][::4]
+        pairs = [(one, two) for start, one in enumerate(concepts)
+                 for two in concepts[start + 1:]]
+        reversed_pairs = [(two, one) for one, two in pairs]
+        
+        for combined in (False, True):
+            for comparer in (plugin.lin("seco"),
+                             plugin.jiang("seco", None, True)):
+                expected = [comparer.compare(one, two) for one, two in pairs]
+                
+                plugin.COMBINED_QUERIES = combined
+                cache = plugin.set_pair_cache(1)
+                try:
+                    for (one, two), value in zip(pairs, expected):
+                        result = comparer.compare(one, two)
+                        assert abs(result - value) < EPSILON
+                    assert cache.hits == 0
+                    assert cache.misses == len(pairs)
+                    
+                    # The reversed pairs are all hits, also in batches
+                    results = comparer.compare_many(reversed_pairs)
+                    for result, value in zip(results, expected):
+                        assert abs(result - value) < EPSILON
+                    assert cache.hits == len(pairs)
+                    assert cache.misses == len(pairs)
+                    
+                    # And so are those of a lifted comparer
+                    lifted = list_plugin.lift_concept_comparer(
+                        comparer, list_plugin.list_max())
+                    lifted.compare(concepts[3:], concepts[:3])
+                    assert cache.hits > len(pairs)
+                    assert cache.misses == len(pairs)
+                finally:
+                    plugin.COMBINED_QUERIES = False
+                    plugin.set_pair_cache(None)
+    
+    
+    def test_lifted_comparers(self):
+        concepts = sorted(IC_TESTS)
+        one = concepts[:8]
+        two = concepts[5:15]
+        for comparer in (plugin.lin("seco"), plugin.jiang("zhou", None, True)):
+            lifted = list_plugin.lift_concept_comparer(
+                comparer, list_plugin.list_bma())
+            expected = lifted.compare(one, two)
+            
+            cache = plugin.set_pair_cache(1)
+            try:
+                assert abs(lifted.compare(one, two) - expected) < EPSILON
+                misses = cache.misses
+                assert misses > 0
+                
+                # The second time, every shared IC is in the cache
+                assert abs(lifted.compare(one, two) - expected) < EPSILON
+                assert cache.misses == misses
+                assert cache.hits > 0
+            finally:
+                plugin.set_pair_cache(None)
+
+
+class TestClosureCache:
+    
+    def test_cached_results(self):
+        concepts = sorted(IC_TESTS)
+        items = [concepts[start:start + 4] for start in range(0, 40, 5)]
+        pairs = [(one, two) for one in items for two in items]
+        comparers = [gic_plugin.sim_ui()]
+        for ic in IC_NAMES:
+            comparers.append(gic_plugin.sim_gic(ic))
+            comparers.append(gic_plugin.sim_gic(ic, "superparts"))
+        
+        expected = [[comparer.compare(one, two) for one, two in pairs]
+                    for comparer in comparers]
+        
+        gic_plugin.CACHE_CLOSURES = True
+        try:
+            for comparer, values in zip(comparers, expected):
+                for (one, two), value in zip(pairs, values):
+                    result = comparer.compare(one, two)
+                    assert abs(result - value) < EPSILON
+        finally:
+            gic_plugin.CACHE_CLOSURES = False
+    
+    
+    def test_join(self):
+        concepts = sorted(IC_TESTS)
+        items = [concepts[start:start + 3] for start in range(0, 40, 4)]
+        for comparer in (gic_plugin.sim_ui(), gic_plugin.sim_gic("seco"),
+                         gic_plugin.sim_gic("zhou", "superparts")):
+            expected = []
+            for one in range(len(items)):
+                for two in range(one, len(items)):
+                    value = comparer.compare(items[one], items[two])
+                    if value >= 0.25:
+                        expected.append((one, two, value))
+            
+            results = comparer.join(items, 0.25)
+            assert [r[:2] for r in results] == [e[:2] for e in expected]
+            for result, value in zip(results, expected):
+                assert abs(result[2] - value[2]) < EPSILON
+    
+    
+    def test_join_min_ic(self):
+        concepts = sorted(IC_TESTS)
+        items = [concepts[start:start + 3] for start in range(0, 40, 4)]
+        calculator = plugin.ICCalculator("seco")
+        for comparer in (gic_plugin.sim_ui(), gic_plugin.sim_gic("seco")):
+            for min_ic in (0.3, 0.6):
+                # Only the pairs with some common superclass with enough IC
+                # are reported
+                expected = []
+                for one in range(len(items)):
+                    for two in range(one, len(items)):
+                        value = comparer.compare(items[one], items[two])
+                        first, _, _ = comparer.closures.get(
+                            gic_plugin.to_id_strings(items[one]))
+                        second, _, _ = comparer.closures.get(
+                            gic_plugin.to_id_strings(items[two]))
+                        common = gic_plugin.intersect(first, second)
+                        if value >= 0.1 and any(
+                                calculator.get(i) >= min_ic for i in common):
+                            expected.append((one, two, value))
+                
+                results = comparer.join(items, 0.1, min_ic)
+                assert [r[:2] for r in results] == [e[:2] for e in expected]
+                for result, value in zip(results, expected):
+                    assert abs(result[2] - value[2]) < EPSILON
+
+
+class TestStaging:
+    
+    def test_staged_results(self):
+        concepts = sorted(IC_TESTS)
+        items = [concepts[start:start + 6] for start in range(0, 40, 5)]
+        pairs = [(one, two) for one in items for two in items]
+        comparers = [gic_plugin.sim_ui(), gic_plugin.sim_gic("seco")]
+        
+        expected = [[comparer.compare(one, two) for one, two in pairs]
+                    for comparer in comparers]
+        
+        gic_plugin.STAGING_SIZE = 3
+        try:
+            for comparer, values in zip(comparers, expected):
+                results = comparer.compare_many(pairs)
+                for (one, two), value, many in zip(pairs, values, results):
+                    assert abs(comparer.compare(one, two) - value) < EPSILON
+                    assert abs(many - value) < EPSILON
+        finally:
+            gic_plugin.STAGING_SIZE = None
+
+
+class TestNeighborhoodCache:
+    
+    def test_cached_results(self):
+        concepts = sorted(IC_TESTS)[::4]
+        comparers = [ferreira_plugin.ferreira(),
+                     ferreira_plugin.ferreira(ic="seco")]
+        expected = [[comparer.compare(one, two)
+                     for one in concepts for two in concepts]
+                    for comparer in comparers]
+        
+        cache = ferreira_plugin.set_neighborhood_cache(100)
+        try:
+            for comparer, values in zip(comparers, expected):
+                results = [comparer.compare(one, two)
+                           for one in concepts for two in concepts]
+                for result, value in zip(results, values):
+                    assert abs(result - value) < EPSILON
+            
+            # Each comparer constructs the neighborhood of each concept once
+            assert cache.misses == len(comparers) * len(concepts)
+        finally:
+            ferreira_plugin.set_neighborhood_cache(None)
+
+
+class TestPreloadedRelations:
+    
+    def test_preloaded_neighborhoods(self):
+        concepts = sorted(IC_TESTS)
+        options = [{}, {"ic": "seco"}, {"discover_subclasses": True}]
+        
+        expected = []
+        for kwargs in options:
+            comparer = ferreira_plugin.ferreira(**kwargs)
+            expected.append([comparer.find_and_weigh_neighbors([concept])
+                             for concept in utils.seq_to_ids(concepts)])
+        
+        ferreira_plugin.PRELOAD_RELATIONS = True
+        try:
+            for kwargs, neighborhoods in zip(options, expected):
+                comparer = ferreira_plugin.ferreira(**kwargs)
+                for concept, neighborhood in zip(utils.seq_to_ids(concepts),
+                                                 neighborhoods):
+                    result = comparer.find_and_weigh_neighbors([concept])
+                    assert set(result) == set(neighborhood)
+                    for key, weight in neighborhood.items():
+                        assert abs(result[key] - weight) < EPSILON
+        finally:
+            ferreira_plugin.PRELOAD_RELATIONS = False
+
+
+
+def stack_neighbors(comparer, chain):
+    # The original depth-first traversal of `find_and_weigh_neighbors`, which
+    # expands every chain within the thresholds
+    result = {}
+    chain_weight = (comparer.get_properties_weight(chain[:-1]) *
+                    comparer.get_ic(chain[-1]))
+    todo = [(chain[-1], len(chain) - 1, chain_weight)]
+    while todo:
+        concept_id, prev_distance, prev_weight = todo.pop()
+        result[concept_id] = max(result.get(concept_id, 0), prev_weight)
+        
+        max_distance = comparer.distance_threshold - prev_distance
+        for relative, distance, factor in comparer.get_neighbors(
+                concept_id, max_distance):
+            current_distance = prev_distance + distance
+            current_weight = prev_weight * factor
+            if (current_distance <= comparer.distance_threshold and
+                    current_weight >= comparer.weight_threshold):
+                todo.append((relative, current_distance, current_weight))
+    return result
+
+
+class TestBestFirst:
+    
+    def test_same_neighborhoods(self):
+        concepts = utils.seq_to_ids(sorted(IC_TESTS))
+        options = [
+            {},
+            {"distance_threshold": 1},
+            {"distance_threshold": 5, "weight_threshold": 0.1},
+            {"hierarchy_weight": 0},
+            {"default_weight": 0.9, "hierarchy_weight": 0.5,
+             "discover_subclasses": True},
+            {"property_weights": {BASE_IRI + "eats": 1.0},
+             "hierarchy_weight": 1.0, "weight_threshold": 0.01,
+             "distance_threshold": 4},
+        ]
+        
+        for kwargs in options:
+            comparer = ferreira_plugin.ferreira(**kwargs)
+            for concept in concepts:
+                expected = stack_neighbors(comparer, [concept])
+                result = comparer.find_and_weigh_neighbors([concept])
+                assert set(result) == set(expected)
+                for key, weight in expected.items():
+                    assert abs(result[key] - weight) < EPSILON
+
+
+class TestThreads:
+    
+    def get_comparers(self, threads):
+        inner = list_plugin.lift_concept_comparer(
+            plugin.lin("seco", None, True), list_plugin.list_bma())
+        other = list_plugin.lift_concept_comparer(
+            gic_plugin.sim_gic("zhou"), list_plugin.list_avg())
+        return [
+            model_plugin.aggregative_comparer(inner, model_plugin.model_avg(),
+                                              None, threads),
+            model_plugin.simple_model_comparer(
+                {"a": inner, "b": other, "c": inner},
+                model_plugin.model_max(), threads),
+        ]
+    
+    
+    def test_same_similarities(self):
+        concepts = sorted(IC_TESTS)
+        generator = random.Random(2)
+        models = []
+        for _ in range(12):
+            domains = generator.sample("abcd", generator.randint(1, 4))
+            models.append({domain: generator.sample(concepts,
+                                                    generator.randint(0, 5))
+                           for domain in domains})
+        
+        expected = [[comparer.compare(one, two)
+                     for one in models for two in models]
+                    for comparer in self.get_comparers(None)]
+        
+        sql.set_connection("localhost", "owltosql", "owltosql", "owltosql",
+                           pool_size=2)
+        try:
+            for comparer, values in zip(self.get_comparers(2), expected):
+                results = [comparer.compare(one, two)
+                           for one in models for two in models]
+                assert results == values
+        finally:
+            sql.close_connection()
+            sql.set_connection("localhost", "owltosql", "owltosql",
+                               "owltosql")
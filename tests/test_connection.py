@@ -1,5 +1,6 @@
+import pytest
 
-from mossy import sql, utils
+from mossy import iri_dictionary, sql, utils
 
 KNOWN_ENTITIES = [
     ("http://www.w3.org/2002/07/owl#Thing",             "Class"),
@@ -67,6 +68,43 @@ def test_make_query():
         sql.cursor.execute("SELECT COUNT(*) FROM owl_objects")
         return sql.cursor.fetchone()[0]
 
+
+def test_connection_pool():
+    sql.set_connection("localhost", "owltosql", "owltosql", "owltosql",
+                       pool_size=2)
+    
+    # Both connections can be borrowed at the same time
+    with sql.borrow() as first, sql.borrow() as second:
+        assert first is not second
+        first.execute("SELECT COUNT(*) FROM owl_objects")
+        second.execute("SELECT COUNT(*) FROM owl_objects")
+        assert first.fetchone()[0] == second.fetchone()[0]
+    
+    sql.close_connection()
+    sql.set_connection("localhost", "owltosql", "owltosql", "owltosql")
+
+def test_sqlite_export(tmpdir):
+    filename = str(tmpdir.join("owltosql.sqlite"))
+    sql.export_to_sqlite(filename)
+    
+    counts = {}
+    for table in ("owl_objects", "hierarchy", "intrinsic_ic"):
+        with sql.borrow() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM {}".format(table))
+            counts[table] = cursor.fetchone()[0]
+    
+    sql.close_connection()
+    sql.set_sqlite_connection(filename)
+    try:
+        for table, count in counts.items():
+            with sql.borrow() as cursor:
+                cursor.execute("SELECT COUNT(*) FROM {}".format(table))
+                assert cursor.fetchone()[0] == count
+    finally:
+        sql.close_connection()
+        sql.set_connection("localhost", "owltosql", "owltosql", "owltosql")
+
+
 def test_utils_get_id():
     for iri, entity_type in KNOWN_ENTITIES + UNKNOWN_ENTITIES:
         entity_id = utils.get_id(iri, entity_type=entity_type)
@@ -75,3 +113,76 @@ def test_utils_get_id():
         assert iri == fetched_iri and entity_type == fetched_type
     
     assert utils.get_entity(1000) == None
+
+
+def test_utils_compile_item():
+    wolf, rabbit, swim = (iri for iri, entity_type in KNOWN_ENTITIES[1:4])
+    wolf_id, rabbit_id, swim_id = (utils.get_id(i)
+                                   for i in (wolf, rabbit, swim))
+    
+    assert utils.compile_item(wolf) == wolf_id
+    assert utils.get_id(wolf_id) == wolf_id
+    compiled = utils.compile_item([swim, wolf])
+    assert compiled == tuple(sorted((wolf_id, swim_id)))
+    
+    model = utils.compile_item({"a": [rabbit, wolf], "b": [wolf]})
+    assert model["a"] == tuple(sorted((wolf_id, rabbit_id)))
+    assert utils.model_to_seq(model) == tuple(sorted((wolf_id, rabbit_id)))
+
+
+def test_utils_prefetch_ids():
+    expected = {entity: utils.get_id(*entity) for entity in KNOWN_ENTITIES}
+    
+    utils.ENTITY_CACHE.clear()
+    utils.ID_CACHE.clear()
+    utils.prefetch_ids([iri for iri, entity_type in KNOWN_ENTITIES],
+                       batch_size=10)
+    
+    for entity, entity_id in expected.items():
+        assert utils.ENTITY_CACHE[entity] == entity_id
+        assert utils.ID_CACHE[entity_id] == entity
+    
+    # The unknown IRIs get new ids during the prefetch, without any further
+    # queries
+    unknown = [iri for entity_type, iri in UNKNOWN_ENTITIES]
+    utils.prefetch_ids(unknown)
+    ids = [utils.ENTITY_CACHE[iri, "Class"] for iri in unknown]
+    assert len(set(ids)) == len(ids)
+    assert all(i not in expected.values() for i in ids)
+    assert [utils.get_id(iri) for iri in unknown] == ids
+
+
+def test_iri_dictionary(tmpdir):
+    filename = str(tmpdir.join("iris.dict"))
+    
+    # The expected ids must come from the database, not from the dictionary
+    iri_dictionary.close_dictionary()
+    utils.ENTITY_CACHE.clear()
+    utils.ID_CACHE.clear()
+    expected = {entity: utils.get_id(*entity) for entity in KNOWN_ENTITIES}
+    
+    # The first time the file is created; the second time it is reused
+    for _ in range(2):
+        dictionary = iri_dictionary.open_dictionary(filename)
+        try:
+            for (iri, entity_type), entity_id in expected.items():
+                assert dictionary.get_id(iri, entity_type) == entity_id
+                assert dictionary.get_entity(entity_id) == (iri, entity_type)
+            
+            for entity_type, iri in UNKNOWN_ENTITIES:
+                assert dictionary.get_id(iri, entity_type) is None
+        finally:
+            iri_dictionary.close_dictionary()
+
+
+def test_sqlite_missing_file(tmpdir):
+    filename = str(tmpdir.join("missing.sqlite"))
+    with pytest.raises(sql.DatabaseError):
+        sql.set_sqlite_connection(filename)
+    assert not tmpdir.join("missing.sqlite").exists()
+
+
+def test_sqlite_placeholders():
+    assert sql.to_qmark("SELECT %s") == "SELECT ?"
+    assert (sql.to_qmark("SELECT '%s', 'it''s %s', %s FROM t WHERE a = %s")
+            == "SELECT '%s', 'it''s %s', ? FROM t WHERE a = ?")